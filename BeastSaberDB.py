@@ -19,178 +19,404 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
-import sqlite3
-import contextlib
+import os
+import math
+import heapq
 import json
 import time
-from lxml import etree
-from CachedRequests import CachedRequests
-from Song import Song
+import collections
+import itertools
+import threading
+import concurrent.futures
+from SongArchiveIndexer import index_song_archive
+from SongDatabase import SongDatabase
+from Metrics import Metrics
 
-def _dict_factory(cursor, row):
-	result = { }
-	for idx, col in enumerate(cursor.description):
-		result[col[0]] = row[idx]
-	return result
+def _parallel_imap(function, iterable, jobs, lookahead = None, executor_class = concurrent.futures.ThreadPoolExecutor):
+	# Like map(), but keeps up to "lookahead" items in flight in a thread (or
+	# process) pool while yielding results strictly in order.
+	if jobs is None:
+		jobs = os.cpu_count()
+	if lookahead is None:
+		lookahead = 2 * jobs
+	iterator = iter(iterable)
+	with executor_class(max_workers = jobs) as executor:
+		pending = collections.deque(executor.submit(function, item) for item in itertools.islice(iterator, lookahead))
+		try:
+			while len(pending) > 0:
+				result = pending.popleft().result()
+				for item in itertools.islice(iterator, 1):
+					pending.append(executor.submit(function, item))
+				yield result
+		finally:
+			for future in pending:
+				future.cancel()
 
-class BeastSaberDB():
+def _extract_cached_song_details(cached_page):
+	from SongDetailsExtractor import extract_song_details
+	(song_key, timestamp, content) = cached_page
+	t0 = time.perf_counter()
+	try:
+		details = extract_song_details(content)
+	except (AssertionError, IndexError, KeyError, ValueError) as e:
+		# Reported and skipped by the caller
+		details = e
+	return (song_key, timestamp, details, time.perf_counter() - t0)
+
+class BeastSaberDB(SongDatabase):
 	_URIS = {
-		"api_desc":			"https://bsaber.com/wp-json/bsaber-api",
-		"rating":			"https://bsaber.com/wp-json/bsaber-api/songs/%(song_key)s/ratings",
-		"songs":			"https://bsaber.com/wp-json/bsaber-api/songs",
-		"details_html":		"https://bsaber.com/songs/%(song_key)s/",
+		"api_desc":			"%(base_uri)s/wp-json/bsaber-api",
+		"rating":			"%(base_uri)s/wp-json/bsaber-api/songs/%(song_key)s/ratings",
+		"songs":			"%(base_uri)s/wp-json/bsaber-api/songs",
+		"details_html":		"%(base_uri)s/songs/%(song_key)s/",
 	}
 
-	def __init__(self, dbfile = "beastsaber.sqlite3"):
-		self._session = CachedRequests(fixed_headers = { "Accept": "application/json" }, minimum_gracetime_secs = 1.0, cache_failed_requests = False)
-		self._db = sqlite3.connect(dbfile)
-		self._cursor = self._db.cursor()
-		self._dict_cursor = self._db.cursor()
-		self._dict_cursor.row_factory = _dict_factory
-
-		with contextlib.suppress(sqlite3.OperationalError):
-			self._cursor.execute("""
-				CREATE TABLE songs (
-					id integer NOT NULL PRIMARY KEY,
-					song_key varchar NOT NULL UNIQUE,
-					level_author varchar NOT NULL,
-					title varchar NOT NULL,
-					hash varchar NOT NULL,
-					rating_update_timet float NULL,
-					rating_fun float NULL,
-					rating_rhythm float NULL,
-					rating_flow float NULL,
-					rating_pattern_quality float NULL,
-					rating_readability float NULL,
-					rating_level_quality float NULL,
-					metadata_update_timet float NULL,
-					difficulty_easy boolean NULL,
-					difficulty_normal boolean NULL,
-					difficulty_hard boolean NULL,
-					difficulty_expert boolean NULL,
-					difficulty_expertplus boolean NULL,
-					recommended boolean NULL,
-					thumbs_up integer NULL,
-					thumbs_down integer NULL,
-					categories_json varchar NULL
-				);
-			""")
-		self._db.commit()
+	def __init__(self, dbfile = "beastsaber.sqlite3", request_rate = 1.0, metrics = None, base_uri = "https://bsaber.com", cache_filename = ".requests_cache.sqlite3"):
+		super().__init__(dbfile)
+		self._base_uri = base_uri
+		self._cache_filename = cache_filename
+		self._request_rate = request_rate
+		self._metrics = metrics if (metrics is not None) else Metrics()
+		self._session_lock = threading.Lock()
+		self._cached_requests = None
+
+	@property
+	def _session(self):
+		# The network stack (requests, lxml) and the request cache are only
+		# set up once the first request is issued
+		with self._session_lock:
+			if self._cached_requests is None:
+				from CachedRequests import CachedRequests
+				self._cached_requests = CachedRequests(cache_filename = self._cache_filename, fixed_headers = { "Accept": "application/json" }, rate_limit = self._request_rate, cache_failed_requests = False, revalidate = True, write_behind = True, metrics = self._metrics)
+			return self._cached_requests
+
+	@property
+	def metrics(self):
+		return self._metrics
+
+	def close(self):
+		with self._session_lock:
+			if self._cached_requests is not None:
+				self._cached_requests.close()
+		super().close()
+
+	def _uri(self, name, **params):
+		return self._URIS[name] % dict(params, base_uri = self._base_uri)
 
 	def get_rating(self, song_key, max_age_secs = 86400):
 		assert(isinstance(song_key, str))
-		return self._session.get(self._URIS["rating"] % { "song_key": song_key }, max_age_secs = max_age_secs, return_json = True)
+		return self._session.get(self._uri("rating", song_key = song_key), max_age_secs = max_age_secs, return_json = True)
 
 	def get_api_desc(self, max_age_secs = 86400 * 7):
-		return self._session.get(self._URIS["api_desc"], max_age_secs = max_age_secs, return_json = True)
+		return self._session.get(self._uri("api_desc"), max_age_secs = max_age_secs, return_json = True)
 
 	def get_songs(self, page = 1, max_age_secs = 86400 * 7):
-		return self._session.get(self._URIS["songs"], query_params = { "page": str(page) }, max_age_secs = max_age_secs, return_json = True)
+		return self._session.get(self._uri("songs"), query_params = { "page": str(page) }, max_age_secs = max_age_secs, return_json = True)
 
-	def fill_songs_db(self, page = 1):
-		result = self.get_songs(page = page)
+	@staticmethod
+	def _song_list_rows(result):
 		for song in result["songs"]:
 			if len(song["song_key"]) == 0:
 				continue
-			with contextlib.suppress(sqlite3.IntegrityError):
-				self._cursor.execute("INSERT INTO songs (song_key, level_author, title, hash) VALUES (?, ?, ?, ?);", (song["song_key"], song["level_author_name"], song["title"], song["hash"]))
+			yield (song["song_key"], song["level_author_name"], song["title"], song["hash"])
+
+	def _insert_songs(self, result):
+		with self._metrics.timed("db_write_seconds"):
+			self._cursor.executemany("INSERT OR IGNORE INTO songs (song_key, level_author, title, hash) VALUES (?, ?, ?, ?);", self._song_list_rows(result))
+
+	def fill_songs_db(self, page = 1):
+		result = self.get_songs(page = page)
+		self._insert_songs(result)
 		self._db.commit()
 		return result["next_page"]
 
-	def fill_songs_complete_db(self, verbose = False):
-		page = 1
-		while page is not None:
-			if verbose:
-				print("Retrieving page %d" % (page))
-			page = self.fill_songs_db(page)
+	def fill_songs_complete_db(self, verbose = False, prefetch = 4, checkpoint_pages = 100):
+		# The API always points to page + 1 as the next page, so we can
+		# speculatively request the next pages while the current one is being
+		# ingested. All inserts happen in one transaction which is only
+		# committed every couple of pages.
+		def retrieve(page):
+			return (page, self.get_songs(page = page))
+
+		pages = _parallel_imap(retrieve, itertools.count(1), jobs = prefetch)
+		try:
+			for (page, result) in pages:
+				if verbose:
+					print("Retrieving page %d" % (page))
+				self._insert_songs(result)
+				if (page % checkpoint_pages) == 0:
+					with self._metrics.timed("db_write_seconds"):
+						self._db.commit()
+				if result["next_page"] is None:
+					break
+				assert(int(result["next_page"]) == page + 1)
+		finally:
+			pages.close()
+			self._db.commit()
+
+	@staticmethod
+	def _rating_row(song_key, rating):
+		return (time.time(), rating["average_ratings"]["fun_factor"], rating["average_ratings"]["rhythm"], rating["average_ratings"]["flow"], rating["average_ratings"]["pattern_quality"], rating["average_ratings"]["readability"], rating["average_ratings"]["level_quality"], song_key)
+
+	def _store_ratings(self, rows):
+		with self._metrics.timed("db_write_seconds"):
+			self._cursor.executemany("UPDATE songs SET rating_update_timet = ?, rating_fun = ?, rating_rhythm = ?, rating_flow = ?, rating_pattern_quality = ?, rating_readability = ?, rating_level_quality = ? WHERE song_key = ?;", rows)
 
 	def retrieve_rating(self, song_key):
 		assert(isinstance(song_key, str))
 		rating = self.get_rating(song_key)
-		self._cursor.execute("UPDATE songs SET rating_update_timet = ?, rating_fun = ?, rating_rhythm = ?, rating_flow = ?, rating_pattern_quality = ?, rating_readability = ?, rating_level_quality = ? WHERE song_key = ?;",
-				(time.time(), rating["average_ratings"]["fun_factor"], rating["average_ratings"]["rhythm"], rating["average_ratings"]["flow"], rating["average_ratings"]["pattern_quality"], rating["average_ratings"]["readability"], rating["average_ratings"]["level_quality"], song_key))
+		self._store_ratings([ self._rating_row(song_key, rating) ])
+
+	def retrieve_ratings_for(self, song_keys, jobs = 1):
+		def retrieve(song_key):
+			return (song_key, self.get_rating(song_key))
+		rows = [ self._rating_row(song_key, rating) for (song_key, rating) in _parallel_imap(retrieve, song_keys, jobs = jobs) ]
+		self._store_ratings(rows)
+		with self._metrics.timed("db_write_seconds"):
+			self._db.commit()
 
-	def retrieve_missing_ratings(self):
-		for row in self._cursor.execute("SELECT song_key FROM songs WHERE rating_update_timet is NULL;").fetchall():
-			song_key = row[0]
-			self.retrieve_rating(song_key)
+	def retrieve_missing_ratings(self, jobs = 1):
+		song_keys = [ row[0] for row in self._cursor.execute("SELECT song_key FROM songs WHERE rating_update_timet is NULL;").fetchall() ]
+		self.retrieve_ratings_for(song_keys, jobs = jobs)
+
+	def _known_song_keys(self, song_keys):
+		song_keys = list(song_keys)
+		if len(song_keys) == 0:
+			return set()
+		sql = "SELECT song_key FROM songs WHERE song_key IN (%s);" % (", ".join("?" for song_key in song_keys))
+		return set(row[0] for row in self._cursor.execute(sql, song_keys).fetchall())
+
+	def sync_new_songs(self, verbose = False, jobs = 1):
+		# The song list is ordered newest-first, so as soon as a page only
+		# contains songs which we already know, everything after it is known
+		# as well.
+		new_song_keys = [ ]
+		page = 1
+		while page is not None:
+			result = self.get_songs(page = page, max_age_secs = 0)
+			rows = list(self._song_list_rows(result))
+			known_song_keys = self._known_song_keys(row[0] for row in rows)
+			new_rows = [ row for row in rows if row[0] not in known_song_keys ]
+			if verbose:
+				print("Page %d: %d of %d songs are new" % (page, len(new_rows), len(rows)))
+			if len(new_rows) == 0:
+				break
+			self._cursor.executemany("INSERT OR IGNORE INTO songs (song_key, level_author, title, hash) VALUES (?, ?, ?, ?);", new_rows)
+			new_song_keys += [ row[0] for row in new_rows ]
+			page = result["next_page"]
 		self._db.commit()
 
-	def retrieve_song_details(self, song_key):
+		if len(new_song_keys) > 0:
+			self.fill_song_details_for(new_song_keys, verbose = verbose, jobs = jobs)
+			self.retrieve_ratings_for(new_song_keys, jobs = jobs)
+		return new_song_keys
+
+	def retrieve_song_details(self, song_key, max_age_secs = None):
 		assert(isinstance(song_key, str))
-		result = self._session.get(self._URIS["details_html"] % { "song_key": song_key })
-		html = etree.HTML(result.content)
-
-		difficulties = html.xpath("//a[@class='post-difficulty']/text()")
-		categories = html.xpath("//span[@class='bsaber-categories']/a/text()")
-		thumbs_up_down = html.xpath("//span[@class='post-stat']")
-		assert(thumbs_up_down[0].xpath("i")[0].get("class") == "fa fa-thumbs-up fa-fw")
-		assert(thumbs_up_down[1].xpath("i")[0].get("class") == "fa fa-thumbs-down fa-fw")
-		thumbs_up = int("".join(thumbs_up_down[0].xpath("text()")).strip())
-		thumbs_down = int("".join(thumbs_up_down[1].xpath("text()")).strip())
-		recommended = len(html.xpath("//div[@class='post-recommended bsaber-tooltip -recommended']")) > 0
-
-		return {
-			"difficulties": set(difficulty.lower() for difficulty in difficulties),
-			"categories":	set(category.lower() for category in categories),
-			"thumbs_up":	thumbs_up,
-			"thumbs_down":	thumbs_down,
-			"recommended":	recommended,
-		}
+		from SongDetailsExtractor import extract_song_details
+		result = self._session.get(self._uri("details_html", song_key = song_key), max_age_secs = max_age_secs)
+		with self._metrics.timed("parse_seconds"):
+			return extract_song_details(result.content)
+
+	@staticmethod
+	def _song_details_row(song_key, details, timestamp = None):
+		categories_json = json.dumps(sorted(list(details["categories"])))
+		return (timestamp if (timestamp is not None) else time.time(), "easy" in details["difficulties"], "normal" in details["difficulties"], "hard" in details["difficulties"], "expert" in details["difficulties"], "expert+" in details["difficulties"], details["thumbs_up"], details["thumbs_down"], details["recommended"], categories_json, song_key)
+
+	def _store_song_details(self, rows):
+		rows = list(rows)
+		with self._metrics.timed("db_write_seconds"):
+			# The vote velocity (votes per day) is derived from the previous
+			# vote count and timestamp; it's used to prioritize refreshes.
+			self._cursor.executemany("""UPDATE songs SET
+				vote_velocity = CASE WHEN (metadata_update_timet IS NOT NULL) AND (?1 > metadata_update_timet) THEN ((?7 + ?8) - (thumbs_up + thumbs_down)) / ((?1 - metadata_update_timet) / 86400) ELSE vote_velocity END,
+				metadata_update_timet = ?1, difficulty_easy = ?2, difficulty_normal = ?3, difficulty_hard = ?4, difficulty_expert = ?5, difficulty_expertplus = ?6, thumbs_up = ?7, thumbs_down = ?8, recommended = ?9, categories_json = ?10 WHERE song_key = ?11;""", rows)
+			self._store_song_categories((row[10], row[9]) for row in rows)
+			self._db.commit()
 
 	def fill_song_details(self, song_key, verbose = False):
 		details = self.retrieve_song_details(song_key)
 		if verbose:
 			print(song_key, details)
-		categories_json = json.dumps(sorted(list(details["categories"])))
-		self._cursor.execute("UPDATE songs SET metadata_update_timet = ?, difficulty_easy = ?, difficulty_normal = ?, difficulty_hard = ?, difficulty_expert = ?, difficulty_expertplus = ?, thumbs_up = ?, thumbs_down = ?, recommended = ?, categories_json = ? WHERE song_key = ?;",
-				(time.time(), "easy" in details["difficulties"], "normal" in details["difficulties"], "hard" in details["difficulties"], "expert" in details["difficulties"], "expert+" in details["difficulties"], details["thumbs_up"], details["thumbs_down"], details["recommended"], categories_json, song_key))
-		self._db.commit()
+		self._store_song_details([ self._song_details_row(song_key, details) ])
 		return details
 
-	def fill_missing_song_details(self, verbose = False):
-		song_keys = self._cursor.execute("SELECT song_key FROM songs WHERE metadata_update_timet is NULL ORDER BY song_key ASC;").fetchall()
-		for (rid, row) in enumerate(song_keys):
-			song_key = row[0]
-			details = self.fill_song_details(song_key, verbose = False)
+	def fill_song_details_for(self, song_keys, verbose = False, jobs = 1, batch_size = 100):
+		# Fetching and parsing happens in worker threads (throttled by the
+		# shared rate limiter of the session), database writes are batched in
+		# the calling thread.
+		def retrieve(song_key):
+			return (song_key, self.retrieve_song_details(song_key))
+
+		pending_rows = [ ]
+		try:
+			for (rid, (song_key, details)) in enumerate(_parallel_imap(retrieve, song_keys, jobs = jobs)):
+				pending_rows.append(self._song_details_row(song_key, details))
+				if len(pending_rows) >= batch_size:
+					self._store_song_details(pending_rows)
+					pending_rows = [ ]
+				if verbose:
+					print("%5.1f%% (%d of %d): %s (%s)" % (rid / len(song_keys) * 100, rid, len(song_keys), song_key, str(details)))
+		finally:
+			if len(pending_rows) > 0:
+				self._store_song_details(pending_rows)
+
+	def fill_missing_song_details(self, verbose = False, jobs = 1):
+		song_keys = [ row[0] for row in self._cursor.execute("SELECT song_key FROM songs WHERE metadata_update_timet is NULL ORDER BY song_key ASC;").fetchall() ]
+		self.fill_song_details_for(song_keys, verbose = verbose, jobs = jobs)
+
+	@staticmethod
+	def _refresh_backoff(update_timet, failed_timet, failures):
+		# Songs whose refresh has failed since they were last updated (e.g.,
+		# because they were removed) are retried exponentially less often
+		if (failed_timet is None) or ((update_timet is not None) and (update_timet >= failed_timet)):
+			return 1
+		return 2 ** min(failures, 32)
+
+	def _refresh_priorities(self, now):
+		# Expected staleness of a song: the longer ago it was refreshed (or a
+		# refresh was attempted), the faster it has been gathering votes and
+		# the more popular it is, the more urgent a refresh is. Never
+		# refreshed songs come first.
+		for (song_key, metadata_update_timet, rating_update_timet, total_votes, vote_velocity, details_failed_timet, details_failures, rating_failed_timet, rating_failures) in self._cursor.execute("SELECT song_key, metadata_update_timet, rating_update_timet, total_votes, vote_velocity, details_failed_timet, details_failures, rating_failed_timet, rating_failures FROM songs;"):
+			popularity = 1 + math.log1p(total_votes or 0)
+			details_age_days = (now - max(metadata_update_timet or 0, details_failed_timet or 0)) / 86400
+			yield (details_age_days * popularity * (1 + max(vote_velocity or 0, 0)) / self._refresh_backoff(metadata_update_timet, details_failed_timet, details_failures), song_key, "details")
+			rating_age_days = (now - max(rating_update_timet or 0, rating_failed_timet or 0)) / 86400
+			yield (rating_age_days * popularity / self._refresh_backoff(rating_update_timet, rating_failed_timet, rating_failures), song_key, "rating")
+
+	def _store_refresh_failures(self, kind, song_keys):
+		# Consecutive failures are only counted since the last successful
+		# update of the same kind
+		update_column = "metadata_update_timet" if (kind == "details") else "rating_update_timet"
+		self._cursor.executemany("UPDATE songs SET %s_failures = CASE WHEN %s_failed_timet > COALESCE(%s, 0) THEN %s_failures + 1 ELSE 1 END, %s_failed_timet = ? WHERE song_key = ?;" % (kind, kind, update_column, kind, kind), ((time.time(), song_key) for song_key in song_keys))
+
+	def _plan_refresh(self, budget):
+		refresh_items = heapq.nlargest(budget, self._refresh_priorities(time.time()))
+		self._cursor.executemany("INSERT INTO refresh_queue (song_key, kind, priority) VALUES (?, ?, ?);", ((song_key, kind, priority) for (priority, song_key, kind) in refresh_items))
+		self._db.commit()
+
+	def _refresh_item(self, item):
+		(item_id, song_key, kind) = item
+		try:
+			if kind == "details":
+				result = self._song_details_row(song_key, self.retrieve_song_details(song_key, max_age_secs = 0))
+			else:
+				result = self._rating_row(song_key, self.get_rating(song_key, max_age_secs = 0))
+		except (AssertionError, IndexError, KeyError, ValueError) as e:
+			# Song page or rating cannot be parsed (e.g., song was removed);
+			# skip it so that it cannot stall the queue
+			print("Cannot refresh %s of %s: %s" % (kind, song_key, str(e)))
+			result = None
+		return (item_id, song_key, kind, result)
+
+	def refresh_stale_songs(self, budget, verbose = False, jobs = 1, batch_size = 100):
+		# Plans (at most) "budget" requests by priority and works them off.
+		# Progress is checkpointed in the refresh_queue table, so an
+		# interrupted run is resumed before a new one is planned.
+		(queued_count, ) = self._cursor.execute("SELECT COUNT(*) FROM refresh_queue;").fetchone()
+		if queued_count == 0:
+			self._plan_refresh(budget)
+		elif verbose:
+			print("Resuming interrupted refresh with %d items left" % (queued_count))
+		items = self._cursor.execute("SELECT id, song_key, kind FROM refresh_queue ORDER BY priority DESC;").fetchall()
+
+		done_ids = [ ]
+		details_rows = [ ]
+		rating_rows = [ ]
+		failures = { "details": [ ], "rating": [ ] }
+		def checkpoint():
+			self._store_ratings(rating_rows)
+			self._store_song_details(details_rows)
+			for (kind, song_keys) in failures.items():
+				self._store_refresh_failures(kind, song_keys)
+				song_keys.clear()
+			self._cursor.executemany("DELETE FROM refresh_queue WHERE id = ?;", ((item_id, ) for item_id in done_ids))
+			self._db.commit()
+			done_ids.clear()
+			details_rows.clear()
+			rating_rows.clear()
+
+		for (itemno, (item_id, song_key, kind, result)) in enumerate(_parallel_imap(self._refresh_item, items, jobs = jobs), 1):
+			done_ids.append(item_id)
+			if result is None:
+				failures[kind].append(song_key)
+			else:
+				(details_rows if (kind == "details") else rating_rows).append(result)
+			if len(done_ids) >= batch_size:
+				checkpoint()
 			if verbose:
-				print("%5.1f%% (%d of %d): %s (%s)" % (rid / len(song_keys) * 100, rid, len(song_keys), song_key, str(details)))
-
-	def search_songs(self, must_have_difficulties = None, minimum_percentage = None, minimum_votes = None, must_be_recommended = False, include_categories = None, exclude_categories = None, song_title = None, level_author = None):
-		where = set()
-		where.add("metadata_update_timet IS NOT NULL")
-		if minimum_votes is not None:
-			where.add("(thumbs_up + thumbs_down > %d)" % (minimum_votes))
-		if minimum_percentage is not None:
-			where.add("((1.0 + thumbs_up) / (thumbs_up + thumbs_down + 2)) > %.3f" % (minimum_percentage / 100))
-		if must_have_difficulties is not None:
-			if "easy" in must_have_difficulties:
-				where.add("difficulty_easy = 1")
-			if "normal" in must_have_difficulties:
-				where.add("difficulty_normal = 1")
-			if "hard" in must_have_difficulties:
-				where.add("difficulty_hard = 1")
-			if "expert" in must_have_difficulties:
-				where.add("difficulty_expert = 1")
-			if "expert+" in must_have_difficulties:
-				where.add("difficulty_expertplus = 1")
-		if must_be_recommended:
-			where.add("recommended = 1")
-		if song_title is not None:
-			for word in song_title:
-				where.add("title LIKE '%%%s%%'" % (word))
-		if level_author is not None:
-			for word in level_author:
-				where.add("level_author LIKE '%%%s%%'" % (word))
-
-		where_clause = "WHERE " + (" AND ".join(sorted("(%s)" % (clause) for clause in where)))
-		sql = "SELECT song_key, level_author, title, hash, difficulty_easy, difficulty_normal, difficulty_hard, difficulty_expert, difficulty_expertplus, recommended, thumbs_up, thumbs_down, categories_json FROM songs %s;" % (where_clause)
-		for rowdict in self._dict_cursor.execute(sql).fetchall():
-			song = Song.from_rowdict(rowdict)
-			if include_categories is not None:
-				if not song.includes_all_categories(include_categories):
-					continue
-			if exclude_categories is not None:
-				if song.includes_any_category(exclude_categories):
+				print("%d of %d: %s %s" % (itemno, len(items), kind, song_key if (result is not None) else ("%s failed" % (song_key))))
+		checkpoint()
+		return len(items)
+
+	def reparse_cached_song_details(self, verbose = False, jobs = None, batch_size = 1000):
+		# Re-derives the song details of the whole catalogue from the HTML
+		# pages in the request cache without touching the network. Parsing is
+		# spread over a process pool.
+		song_keys = [ row[0] for row in self._cursor.execute("SELECT song_key FROM songs ORDER BY song_key ASC;").fetchall() ]
+		def cached_pages():
+			for song_key in song_keys:
+				response = self._session.get_cached(self._uri("details_html", song_key = song_key))
+				if (response is not None) and (response.status_code == 200):
+					yield (song_key, time.time() - response.age, response.content)
+
+		reparsed_count = 0
+		pending_rows = [ ]
+		try:
+			for (song_key, timestamp, details, parse_secs) in _parallel_imap(_extract_cached_song_details, cached_pages(), jobs = jobs, lookahead = 64, executor_class = concurrent.futures.ProcessPoolExecutor):
+				self._metrics.observe("parse_seconds", parse_secs)
+				if isinstance(details, Exception):
+					print("Cannot reparse details of %s: %s" % (song_key, str(details)))
 					continue
-			yield song
+				pending_rows.append(self._song_details_row(song_key, details, timestamp = timestamp))
+				if len(pending_rows) >= batch_size:
+					self._store_song_details(pending_rows)
+					pending_rows = [ ]
+				reparsed_count += 1
+				if verbose:
+					print("%d of %d: %s (%s)" % (reparsed_count, len(song_keys), song_key, str(details)))
+		finally:
+			if len(pending_rows) > 0:
+				self._store_song_details(pending_rows)
+		return reparsed_count
+
+	def _store_archive_index(self, filename, file_size, file_mtime, archive):
+		self._metrics.increment("archives_indexed")
+		self._cursor.execute("DELETE FROM archive_failures WHERE filename = ?;", (filename, ))
+		self._cursor.execute("DELETE FROM archive_difficulties WHERE hash = ?;", (archive["hash"], ))
+		self._cursor.execute("INSERT OR REPLACE INTO archives (hash, filename, file_size, file_mtime, index_timet, song_name, song_author, bpm, duration_secs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+				(archive["hash"], filename, file_size, file_mtime, time.time(), archive["song_name"], archive["song_author"], archive["bpm"], archive["duration_secs"]))
+		self._cursor.executemany("INSERT OR REPLACE INTO archive_difficulties (hash, characteristic, difficulty, note_count, bomb_count, obstacle_count, notes_per_second) VALUES (?, ?, ?, ?, ?, ?, ?);",
+				((archive["hash"], difficulty["characteristic"], difficulty["difficulty"], difficulty["note_count"], difficulty["bomb_count"], difficulty["obstacle_count"], difficulty["notes_per_second"]) for difficulty in archive["difficulties"]))
+
+	def index_song_archives(self, directory, verbose = False, jobs = None, batch_size = 100):
+		# Only archives that are new or whose size or modification time has
+		# changed since the last scan are opened again
+		indexed = { filename: (file_size, file_mtime) for (filename, file_size, file_mtime) in self._cursor.execute("SELECT filename, file_size, file_mtime FROM archives;").fetchall() }
+		indexed.update((filename, (file_size, file_mtime)) for (filename, file_size, file_mtime) in self._cursor.execute("SELECT filename, file_size, file_mtime FROM archive_failures;").fetchall())
+		present = { }
+		for entry in os.scandir(directory):
+			if entry.name.lower().endswith(".zip") and entry.is_file(follow_symlinks = False):
+				stat = entry.stat(follow_symlinks = False)
+				present[entry.path] = (stat.st_size, stat.st_mtime)
+
+		removed = [ filename for filename in indexed if filename not in present ]
+		self._cursor.executemany("DELETE FROM archives WHERE filename = ?;", ((filename, ) for filename in removed))
+		self._cursor.executemany("DELETE FROM archive_failures WHERE filename = ?;", ((filename, ) for filename in removed))
+		changed = sorted(filename for (filename, stat) in present.items() if indexed.get(filename) != stat)
+		for (fileno, (filename, archive)) in enumerate(_parallel_imap(index_song_archive, changed, jobs = jobs, lookahead = 64, executor_class = concurrent.futures.ProcessPoolExecutor), 1):
+			(file_size, file_mtime) = present[filename]
+			if isinstance(archive, Exception):
+				print("Cannot index %s: %s" % (filename, str(archive)))
+				self._cursor.execute("DELETE FROM archives WHERE filename = ?;", (filename, ))
+				self._cursor.execute("INSERT OR REPLACE INTO archive_failures (filename, file_size, file_mtime, index_timet, error) VALUES (?, ?, ?, ?, ?);", (filename, file_size, file_mtime, time.time(), "%s: %s" % (type(archive).__name__, str(archive))))
+			else:
+				self._store_archive_index(filename, file_size, file_mtime, archive)
+			if (fileno % batch_size) == 0:
+				self._db.commit()
+			if verbose:
+				print("%d of %d: %s" % (fileno, len(changed), filename))
+		self._cursor.execute("DELETE FROM archive_difficulties WHERE hash NOT IN (SELECT hash FROM archives);")
+		self._db.commit()
+		return (len(changed), len(removed))
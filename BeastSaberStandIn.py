@@ -0,0 +1,134 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import re
+import json
+import time
+import threading
+import urllib.parse
+import http.server
+from SyntheticCatalogue import SyntheticCatalogue
+
+class BeastSaberStandInHandler(http.server.BaseHTTPRequestHandler):
+	_RATING_PATH = re.compile(r"/wp-json/bsaber-api/songs/(?P<song_key>[0-9a-f]+)/ratings")
+	_DETAILS_PATH = re.compile(r"/songs/(?P<song_key>[0-9a-f]+)/")
+
+	def _send(self, status, content_type = None, content = b"", headers = None):
+		self.send_response(status)
+		if content_type is not None:
+			self.send_header("Content-Type", content_type)
+		for (key, value) in (headers or { }).items():
+			self.send_header(key, value)
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def _song_index(self, path_regex, path):
+		match = path_regex.fullmatch(path)
+		if match is None:
+			return None
+		index = self.server.catalogue.song_index(match.group("song_key"))
+		return index if (0 <= index < self.server.catalogue.song_count) else None
+
+	def do_GET(self):
+		self.server.request_started()
+		if self.server.latency_secs > 0:
+			time.sleep(self.server.latency_secs)
+		url = urllib.parse.urlsplit(self.path)
+		catalogue = self.server.catalogue
+		rating_index = self._song_index(self._RATING_PATH, url.path)
+		details_index = self._song_index(self._DETAILS_PATH, url.path)
+		if url.path == "/wp-json/bsaber-api":
+			self._send(200, "application/json", json.dumps({ "name": "bsaber-api", "song_count": catalogue.song_count }).encode("utf-8"))
+		elif url.path == "/wp-json/bsaber-api/songs":
+			page = int(urllib.parse.parse_qs(url.query).get("page", [ "1" ])[0])
+			self._send(200, "application/json", json.dumps(catalogue.song_list_page(page)).encode("utf-8"))
+		elif rating_index is not None:
+			self._send(200, "application/json", json.dumps(catalogue.rating(rating_index)).encode("utf-8"))
+		elif details_index is not None:
+			etag = "\"%s-%d\"" % (catalogue.song_key(details_index), self.server.generation)
+			if self.headers.get("If-None-Match") == etag:
+				self._send(304, headers = { "ETag": etag })
+			else:
+				self._send(200, "text/html; charset=UTF-8", catalogue.details_html(details_index, page_size = self.server.page_size), headers = { "ETag": etag })
+		else:
+			self._send(404, "text/plain", b"Not found.")
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			super().log_message(format, *args)
+
+class BeastSaberStandIn(http.server.ThreadingHTTPServer):
+	# Local HTTP server that emulates the parts of the BeastSaber site that
+	# BeastSaberDB uses, serving a synthetic catalogue with configurable
+	# latency. Bumping the generation invalidates all ETags.
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__(self, catalogue, address = ("127.0.0.1", 0), latency_secs = 0, page_size = 64 * 1024, verbose = False):
+		self.catalogue = catalogue
+		self.latency_secs = latency_secs
+		self.page_size = page_size
+		self.verbose = verbose
+		self.generation = 0
+		self._lock = threading.Lock()
+		self._request_count = 0
+		self._thread = None
+		super().__init__(address, BeastSaberStandInHandler)
+
+	@property
+	def base_uri(self):
+		return "http://%s:%d" % self.server_address[:2]
+
+	@property
+	def request_count(self):
+		return self._request_count
+
+	def request_started(self):
+		with self._lock:
+			self._request_count += 1
+
+	def start(self):
+		self._thread = threading.Thread(target = self.serve_forever, daemon = True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		self._thread.join()
+
+if __name__ == "__main__":
+	import sys
+	from FriendlyArgumentParser import FriendlyArgumentParser
+
+	parser = FriendlyArgumentParser(description = "Serve a synthetic song catalogue which emulates the BeastSaber API.")
+	parser.add_argument("-n", "--song-count", metavar = "count", type = int, default = 1000, help = "Number of songs in the catalogue. Defaults to %(default)d.")
+	parser.add_argument("-l", "--latency", metavar = "msecs", type = float, default = 0, help = "Latency added to every response in milliseconds. Defaults to %(default).0f.")
+	parser.add_argument("-p", "--port", metavar = "port", type = int, default = 8765, help = "Port to listen on. Defaults to %(default)d.")
+	parser.add_argument("--seed", metavar = "seed", type = int, default = 0, help = "Seed of the synthetic catalogue. Defaults to %(default)d.")
+	parser.add_argument("-v", "--verbose", action = "count", default = 0, help = "Increases verbosity. Can be specified multiple times to increase.")
+	args = parser.parse_args(sys.argv[1:])
+
+	server = BeastSaberStandIn(SyntheticCatalogue(args.song_count, seed = args.seed), address = ("127.0.0.1", args.port), latency_secs = args.latency / 1000, verbose = (args.verbose >= 1))
+	print("Serving %d songs on %s" % (args.song_count, server.base_uri))
+	server.serve_forever()
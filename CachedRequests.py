@@ -31,42 +31,185 @@ import contextlib
 import urllib.parse
 import hashlib
 import json
+import threading
+import zlib
+import atexit
+import concurrent.futures
+
+class _NoMetrics():
+	# Used when no metrics collector (with increment(), observe() and
+	# timed()) is passed in, so this module has no further dependencies
+	def increment(self, name, amount = 1):
+		pass
+
+	def observe(self, name, value):
+		pass
+
+	def timed(self, name):
+		return contextlib.nullcontext()
+
+class TokenBucketRateLimiter():
+	def __init__(self, rate, burst = 1):
+		assert(rate > 0)
+		self._rate = rate
+		self._burst = burst
+		self._lock = threading.Lock()
+		self._buckets = { }
+
+	def acquire(self, key):
+		with self._lock:
+			now = time.monotonic()
+			(tokens, last_refill) = self._buckets.get(key, (self._burst, now))
+			tokens = min(self._burst, tokens + (now - last_refill) * self._rate)
+
+			# Take the token now even if it is not available yet; the caller
+			# then sleeps outside of the lock until it would have been
+			# refilled. This way, concurrent callers queue up fairly.
+			tokens -= 1
+			self._buckets[key] = (tokens, now)
+		if tokens < 0:
+			wait_time = -tokens / self._rate
+			time.sleep(wait_time)
+			return wait_time
+		return 0
 
 class CachedRequests():
-	_GenericRequest = collections.namedtuple("GenericRequest", [ "verb", "url", "postdata", "headers", "return_json", "max_age_secs" ])
+	_GenericRequest = collections.namedtuple("GenericRequest", [ "verb", "url", "postdata", "headers", "return_json", "max_age_secs", "revalidate" ])
 	_Response = collections.namedtuple("Response", [ "status_code", "headers", "content", "cached", "age" ])
+	_ACCESS_GRANULARITY_SECS = 60
+	_DICTIONARY_TRAINING_THRESHOLD = 256
+	_EVICTION_BATCH_SIZE = 16
+	_STORE_COLUMNS = ( "request_key", "stored_timestamp", "accessed_timestamp", "verb", "uri", "request_headers_json", "response_headers_json", "status_code", "content_encoding", "content_size", "content" )
 
-	def __init__(self, cache_filename = ".requests_cache.sqlite3", cache_duration_secs = 3600, cache_post = False, fixed_headers = None, minimum_gracetime_secs = None, cache_failed_requests = True):
-		self._session = requests.Session()
-		self._db = sqlite3.connect(cache_filename)
+	def __init__(self, cache_filename = ".requests_cache.sqlite3", cache_duration_secs = 3600, cache_post = False, fixed_headers = None, minimum_gracetime_secs = None, cache_failed_requests = True, rate_limit = None, rate_burst = 1, revalidate = False, max_cache_size = 1024 * 1024 * 1024, write_behind = False, write_batch_size = 64, write_batch_timeout_msecs = 500, metrics = None):
+		self._thread_local = threading.local()
+		self._db_lock = threading.RLock()
+		self._flush_condition = threading.Condition(self._db_lock)
+		self._inflight_lock = threading.Lock()
+		self._inflight = { }
+		self._db = sqlite3.connect(cache_filename, check_same_thread = False)
 		self._cursor = self._db.cursor()
 		self._cache_duration_secs = cache_duration_secs
 		self._cache_post = cache_post
 		self._fixed_headers = fixed_headers
-		self._minimum_gracetime_secs = minimum_gracetime_secs
 		self._cache_failed_requests = cache_failed_requests
+		self._revalidate = revalidate
+		self._max_cache_size = max_cache_size
+		self._write_batch_size = write_batch_size
+		self._write_batch_timeout_secs = write_batch_timeout_msecs / 1000
+		self._pending_stores = { }
+		self._pending_refreshes = { }
+		self._metrics = metrics if (metrics is not None) else _NoMetrics()
+		if (rate_limit is None) and (minimum_gracetime_secs is not None):
+			rate_limit = 1 / minimum_gracetime_secs
+		self._rate_limiter = TokenBucketRateLimiter(rate = rate_limit, burst = rate_burst) if (rate_limit is not None) else None
 		with contextlib.suppress(sqlite3.OperationalError):
 			self._cursor.execute("""
 			CREATE TABLE cached_requests (
 				id integer PRIMARY KEY,
 				request_key varchar UNIQUE,
 				stored_timestamp float NOT NULL,
+				accessed_timestamp float NOT NULL,
 				verb varchar NOT NULL,
 				uri varchar NOT NULL,
 				request_headers_json varchar NOT NULL,
 				response_headers_json varchar NOT NULL,
 				status_code integer NOT NULL,
+				content_encoding varchar NOT NULL DEFAULT 'identity',
+				content_size integer NOT NULL DEFAULT 0,
 				content blob NOT NULL
 			);
 			""")
-
-		expiration_time = time.time() - cache_duration_secs
-		(expired_cache_size, ) = self._cursor.execute("SELECT SUM(LENGTH(content)) FROM cached_requests WHERE stored_timestamp < ?;", (expiration_time, )).fetchone()
-		if (expired_cache_size is not None) and (expired_cache_size > 10 * 1024 * 1024):
-			# Clean up cache if we have more than 10 MiB dangling about
-			self._cursor.execute("DELETE FROM cached_requests WHERE stored_timestamp < ?;", (expiration_time, ))
+		with contextlib.suppress(sqlite3.OperationalError):
+			# Upgrade caches created before compression and LRU eviction
+			self._cursor.execute("ALTER TABLE cached_requests ADD COLUMN accessed_timestamp float NULL;")
+			self._cursor.execute("ALTER TABLE cached_requests ADD COLUMN content_encoding varchar NOT NULL DEFAULT 'identity';")
+			self._cursor.execute("ALTER TABLE cached_requests ADD COLUMN content_size integer NOT NULL DEFAULT 0;")
+			self._cursor.execute("UPDATE cached_requests SET accessed_timestamp = stored_timestamp, content_size = LENGTH(content);")
+		self._cursor.execute("CREATE INDEX IF NOT EXISTS cached_requests_accessed_idx ON cached_requests(accessed_timestamp);")
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("""
+			CREATE TABLE compression_dictionaries (
+				id integer PRIMARY KEY,
+				created_timestamp float NOT NULL,
+				dictionary blob NOT NULL
+			);
+			""")
+		with contextlib.suppress(sqlite3.OperationalError):
+			# Keep running totals up to date with triggers so that enforcing the
+			# size limit never needs to scan the whole table
+			self._cursor.execute("""
+			CREATE TABLE cache_statistics (
+				id integer PRIMARY KEY CHECK (id = 0),
+				entry_count integer NOT NULL,
+				total_size integer NOT NULL
+			);
+			""")
+			self._cursor.execute("INSERT INTO cache_statistics (id, entry_count, total_size) SELECT 0, COUNT(*), COALESCE(SUM(content_size), 0) FROM cached_requests;")
+			self._cursor.execute("CREATE TRIGGER cached_requests_insert AFTER INSERT ON cached_requests BEGIN UPDATE cache_statistics SET entry_count = entry_count + 1, total_size = total_size + new.content_size; END;")
+			self._cursor.execute("CREATE TRIGGER cached_requests_delete AFTER DELETE ON cached_requests BEGIN UPDATE cache_statistics SET entry_count = entry_count - 1, total_size = total_size - old.content_size; END;")
+			self._cursor.execute("CREATE TRIGGER cached_requests_update AFTER UPDATE OF content_size ON cached_requests BEGIN UPDATE cache_statistics SET total_size = total_size - old.content_size + new.content_size; END;")
 		self._db.commit()
 
+		self._dictionaries = { }
+		self._current_dictionary_id = None
+		self._dictionary_training_entry_count = self._DICTIONARY_TRAINING_THRESHOLD
+		result = self._cursor.execute("SELECT id, dictionary FROM compression_dictionaries ORDER BY id DESC LIMIT 1;").fetchone()
+		if result is not None:
+			(self._current_dictionary_id, self._dictionaries[self._current_dictionary_id]) = result
+
+		self._flush_thread = None
+		if write_behind:
+			self._closed = False
+			self._flush_thread = threading.Thread(target = self._flush_thread_main, daemon = True)
+			self._flush_thread.start()
+			atexit.register(self.close)
+
+	def _flush_thread_main(self):
+		with self._flush_condition:
+			while not self._closed:
+				self._flush_condition.wait(timeout = self._write_batch_timeout_secs)
+				self.flush()
+
+	@property
+	def metrics(self):
+		return self._metrics
+
+	def flush(self):
+		with self._db_lock:
+			t0 = time.perf_counter()
+			write_count = len(self._pending_stores) + len(self._pending_refreshes)
+			if len(self._pending_stores) > 0:
+				sql = "INSERT INTO cached_requests (%s) VALUES (%s) ON CONFLICT(request_key) DO UPDATE SET %s;" % (", ".join(self._STORE_COLUMNS), ", ".join("?" for column in self._STORE_COLUMNS), ", ".join("%s = excluded.%s" % (column, column) for column in self._STORE_COLUMNS[1:]))
+				self._cursor.executemany(sql, self._pending_stores.values())
+				self._pending_stores = { }
+				self._cache_maintenance()
+			if len(self._pending_refreshes) > 0:
+				self._cursor.executemany("UPDATE cached_requests SET stored_timestamp = ?, accessed_timestamp = ? WHERE request_key = ?;", ((timestamp, timestamp, request_hash) for (request_hash, timestamp) in self._pending_refreshes.items()))
+				self._pending_refreshes = { }
+			self._db.commit()
+			if write_count > 0:
+				self._metrics.observe("cache_write_seconds", time.perf_counter() - t0)
+
+	def close(self):
+		if self._flush_thread is not None:
+			with self._flush_condition:
+				self._closed = True
+				self._flush_condition.notify()
+			self._flush_thread.join()
+			self._flush_thread = None
+		self.flush()
+
+	@property
+	def _session(self):
+		# requests.Session is not guaranteed to be thread-safe, so keep one
+		# (keep-alive) session per worker thread
+		session = getattr(self._thread_local, "session", None)
+		if session is None:
+			session = requests.Session()
+			self._thread_local.session = session
+		return session
+
 	@staticmethod
 	def _hash_request(request):
 		request_data = [ request.verb, request.url ]
@@ -103,56 +246,218 @@ class CachedRequests():
 			headers.update(request_headers)
 		return headers
 
-	def _cache_lookup(self, max_age_secs, request_hash):
-		now = time.time()
-		max_age = now - max_age_secs
-		result = self._cursor.execute("SELECT stored_timestamp, response_headers_json, status_code, content FROM cached_requests WHERE (stored_timestamp > ?) AND (request_key = ?);", (max_age, request_hash)).fetchone()
-		if result is None:
-			return None
+	@staticmethod
+	def _header_value(headers, name):
+		name = name.lower()
+		for (key, value) in headers.items():
+			if key.lower() == name:
+				return value
+		return None
+
+	def _get_dictionary(self, dictionary_id):
+		if dictionary_id not in self._dictionaries:
+			(self._dictionaries[dictionary_id], ) = self._cursor.execute("SELECT dictionary FROM compression_dictionaries WHERE id = ?;", (dictionary_id, )).fetchone()
+		return self._dictionaries[dictionary_id]
+
+	def _encode_content(self, content):
+		dictionary_id = self._current_dictionary_id
+		if dictionary_id is None:
+			(encoding, compressor) = ("zlib", zlib.compressobj(level = 6))
+		else:
+			(encoding, compressor) = ("zlib:%d" % (dictionary_id), zlib.compressobj(level = 6, zdict = self._dictionaries[dictionary_id]))
+		compressed = compressor.compress(content) + compressor.flush()
+		if len(compressed) >= len(content):
+			return ("identity", content)
+		return (encoding, compressed)
+
+	def _decode_content(self, encoding, content):
+		if encoding == "identity":
+			return content
+		elif encoding == "zlib":
+			return zlib.decompress(content)
+		elif encoding.startswith("zlib:"):
+			decompressor = zlib.decompressobj(zdict = self._get_dictionary(int(encoding[5:])))
+			return decompressor.decompress(content) + decompressor.flush()
 		else:
-			(stored_timestamp, response_headers_json, status_code, content) = result
-			return self._Response(status_code = status_code, headers = json.loads(response_headers_json), content = content, cached = True, age = now - stored_timestamp)
+			raise NotImplementedError(encoding)
+
+	def train_compression_dictionary(self, sample_count = 256, max_dictionary_size = 32768):
+		# zlib looks for matches in the preset dictionary, so fill it with the
+		# lines that occur in as many of the sampled responses as possible
+		# (e.g., the HTML page skeleton). The most common lines go last, where
+		# they are cheapest to reference.
+		with self._db_lock:
+			samples = self._cursor.execute("SELECT content_encoding, content FROM cached_requests WHERE id IN (SELECT id FROM cached_requests ORDER BY accessed_timestamp DESC LIMIT ?);", (sample_count, )).fetchall()
+			document_frequency = collections.Counter()
+			for (encoding, content) in samples:
+				document_frequency.update(set(self._decode_content(encoding, content).split(b"\n")))
+			common_lines = sorted((count, line) for (line, count) in document_frequency.items() if (count >= 2) and (len(line) >= 8))
+			dictionary = [ ]
+			dictionary_size = 0
+			for (count, line) in reversed(common_lines):
+				if dictionary_size + len(line) + 1 > max_dictionary_size:
+					break
+				dictionary.append(line)
+				dictionary_size += len(line) + 1
+			if len(dictionary) == 0:
+				return
+			dictionary = b"\n".join(reversed(dictionary)) + b"\n"
+			self._cursor.execute("INSERT INTO compression_dictionaries (created_timestamp, dictionary) VALUES (?, ?);", (time.time(), dictionary))
+			self._dictionaries[self._cursor.lastrowid] = dictionary
+			self._current_dictionary_id = self._cursor.lastrowid
+			self._db.commit()
+
+	def _cache_maintenance(self):
+		(entry_count, total_size) = self._cursor.execute("SELECT entry_count, total_size FROM cache_statistics;").fetchone()
+		if (self._current_dictionary_id is None) and (entry_count >= self._dictionary_training_entry_count):
+			self.train_compression_dictionary()
+			if self._current_dictionary_id is None:
+				# Nothing worth a dictionary yet (e.g., only single line JSON
+				# responses); only try again once the cache has grown
+				self._dictionary_training_entry_count = entry_count + self._DICTIONARY_TRAINING_THRESHOLD
+		while (self._max_cache_size is not None) and (total_size > self._max_cache_size) and (entry_count > 0):
+			# Evict the least recently used entries in small batches
+			self._cursor.execute("DELETE FROM cached_requests WHERE id IN (SELECT id FROM cached_requests ORDER BY accessed_timestamp ASC LIMIT ?);", (self._EVICTION_BATCH_SIZE, ))
+			(entry_count, total_size) = self._cursor.execute("SELECT entry_count, total_size FROM cache_statistics;").fetchone()
+
+	def _cache_lookup(self, request_hash):
+		now = time.time()
+		with self._db_lock:
+			if request_hash in self._pending_stores:
+				# Not written back yet
+				row = self._pending_stores[request_hash]
+				result = (row[1], row[2], row[6], row[7], row[8], row[10])
+			else:
+				result = self._cursor.execute("SELECT stored_timestamp, accessed_timestamp, response_headers_json, status_code, content_encoding, content FROM cached_requests WHERE request_key = ?;", (request_hash, )).fetchone()
+			if result is None:
+				return None
+			(stored_timestamp, accessed_timestamp, response_headers_json, status_code, content_encoding, content) = result
+			stored_timestamp = self._pending_refreshes.get(request_hash, stored_timestamp)
+			if (accessed_timestamp is None) or (now - accessed_timestamp > self._ACCESS_GRANULARITY_SECS):
+				self._cursor.execute("UPDATE cached_requests SET accessed_timestamp = ? WHERE request_key = ?;", (now, request_hash))
+				if self._flush_thread is None:
+					self._db.commit()
+			content = self._decode_content(content_encoding, content)
+		return self._Response(status_code = status_code, headers = json.loads(response_headers_json), content = content, cached = True, age = now - stored_timestamp)
+
+	def _cache_refresh(self, request_hash):
+		with self._db_lock:
+			self._pending_refreshes[request_hash] = time.time()
+			if self._flush_thread is None:
+				self.flush()
+
+	def _conditional_headers(self, cached_response):
+		conditional_headers = { }
+		etag = self._header_value(cached_response.headers, "ETag")
+		if etag is not None:
+			conditional_headers["If-None-Match"] = etag
+		last_modified = self._header_value(cached_response.headers, "Last-Modified")
+		if last_modified is not None:
+			conditional_headers["If-Modified-Since"] = last_modified
+		return conditional_headers
 
 	def _cache_store(self, request, request_hash, response):
-		try:
-			self._cursor.execute("INSERT INTO cached_requests (request_key, stored_timestamp, verb, uri, request_headers_json, response_headers_json, status_code, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
-				(request_hash, time.time(), request.verb, request.url, json.dumps(request.headers), json.dumps(response.headers), response.status_code, response.content))
-		except sqlite3.IntegrityError:
-			self._cursor.execute("UPDATE cached_requests SET stored_timestamp = ?, response_headers_json = ?, status_code = ?, content = ? WHERE request_key = ?;",
-				(time.time(), json.dumps(response.headers), response.status_code, response.content, request_hash))
-		self._db.commit()
+		now = time.time()
+		(content_encoding, content) = self._encode_content(response.content)
+		row = (request_hash, now, now, request.verb, request.url, json.dumps(request.headers), json.dumps(response.headers), response.status_code, content_encoding, len(content), content)
+		with self._db_lock:
+			self._pending_stores[request_hash] = row
+			self._pending_refreshes.pop(request_hash, None)
+			if self._flush_thread is None:
+				self.flush()
+			elif len(self._pending_stores) >= self._write_batch_size:
+				self._flush_condition.notify()
 
 	def _execute_uncached(self, request):
-		if self._minimum_gracetime_secs is not None:
-			time.sleep(self._minimum_gracetime_secs)
-		response = requests.request(method = request.verb, url = request.url, data = request.postdata, headers = request.headers)
+		if self._rate_limiter is not None:
+			self._metrics.observe("rate_limit_wait_seconds", self._rate_limiter.acquire(urllib.parse.urlsplit(request.url).netloc))
+		with self._metrics.timed("network_seconds"):
+			response = self._session.request(method = request.verb, url = request.url, data = request.postdata, headers = request.headers)
+		self._metrics.increment("network_requests")
+		self._metrics.increment("network_bytes", len(response.content))
 		return self._Response(status_code = response.status_code, headers = dict(response.headers), content = response.content, cached = False, age = 0)
 
+	def _execute_cached(self, request, request_hash):
+		cached_response = self._cache_lookup(request_hash = request_hash)
+		if cached_response is None:
+			self._metrics.increment("cache_misses")
+		elif cached_response.age < request.max_age_secs:
+			self._metrics.increment("cache_hits")
+			self._metrics.increment("cache_bytes", len(cached_response.content))
+			return cached_response
+		else:
+			self._metrics.increment("cache_stale")
+
+		conditional_headers = { }
+		if (cached_response is not None) and request.revalidate and (cached_response.status_code == 200):
+			conditional_headers = self._conditional_headers(cached_response)
+		if len(conditional_headers) > 0:
+			# The stale entry can be revalidated; the conditional headers are
+			# not part of the request hash.
+			response = self._execute_uncached(request._replace(headers = dict(request.headers, **conditional_headers)))
+			if response.status_code == 304:
+				self._metrics.increment("cache_revalidated")
+				self._metrics.increment("cache_bytes", len(cached_response.content))
+				self._cache_refresh(request_hash)
+				return cached_response._replace(age = 0)
+		else:
+			response = self._execute_uncached(request)
+		if (self._cache_failed_requests) or (response.status_code == 200):
+			self._cache_store(request, request_hash, response)
+		return response
+
+	def _execute_coalesced(self, request):
+		# Single-flight: concurrent callers asking for the same request wait
+		# for the one that is already in flight instead of fetching it again
+		request_hash = self._hash_request(request)
+		with self._inflight_lock:
+			future = self._inflight.get(request_hash)
+			leader = future is None
+			if leader:
+				future = concurrent.futures.Future()
+				self._inflight[request_hash] = future
+		if not leader:
+			self._metrics.increment("coalesced_requests")
+			return future.result()
+
+		try:
+			response = self._execute_cached(request, request_hash)
+			future.set_result(response)
+			return response
+		except Exception as e:
+			future.set_exception(e)
+			raise
+		finally:
+			with self._inflight_lock:
+				del self._inflight[request_hash]
+
 	def _execute(self, request):
 		if (request.verb == "POST") and (not self._cache_post):
 			# Never cache POST requests
 			response = self._execute_uncached(request)
 		else:
-			request_hash = self._hash_request(request)
-			cached_response = self._cache_lookup(max_age_secs = request.max_age_secs, request_hash = request_hash)
-			if cached_response is None:
-				response = self._execute_uncached(request)
-				if (self._cache_failed_requests) or (response.status_code == 200):
-					self._cache_store(request, request_hash, response)
-			else:
-				response = cached_response
+			response = self._execute_coalesced(request)
 		if request.return_json:
 			response = json.loads(response.content)
 		return response
 
-	def get(self, url, query_params = None, headers = None, max_age_secs = None, return_json = False):
-		request = self._GenericRequest(verb = "GET", url = self._build_url(url, query_params), postdata = None, headers = self._determine_headers(headers), max_age_secs = max_age_secs if (max_age_secs is not None) else self._cache_duration_secs, return_json = return_json)
+	def _build_request(self, verb, url, query_params, postdata, headers, max_age_secs, return_json, revalidate):
+		return self._GenericRequest(verb = verb, url = self._build_url(url, query_params), postdata = postdata, headers = self._determine_headers(headers), max_age_secs = max_age_secs if (max_age_secs is not None) else self._cache_duration_secs, return_json = return_json, revalidate = revalidate if (revalidate is not None) else self._revalidate)
+
+	def get(self, url, query_params = None, headers = None, max_age_secs = None, return_json = False, revalidate = None):
+		request = self._build_request("GET", url, query_params = query_params, postdata = None, headers = headers, max_age_secs = max_age_secs, return_json = return_json, revalidate = revalidate)
 		return self._execute(request)
 
-	def post(self, url, query_params = None, postdata = None, headers = None, max_age_secs = None, return_json = False):
-		request = self._GenericRequest(verb = "POST", url = self._build_url(url, query_params), postdata = postdata, headers = self._determine_headers(headers), max_age_secs = max_age_secs if (max_age_secs is not None) else self._cache_duration_secs, return_json = return_json)
+	def post(self, url, query_params = None, postdata = None, headers = None, max_age_secs = None, return_json = False, revalidate = None):
+		request = self._build_request("POST", url, query_params = query_params, postdata = postdata, headers = headers, max_age_secs = max_age_secs, return_json = return_json, revalidate = revalidate)
 		return self._execute(request)
 
+	def get_cached(self, url, query_params = None, headers = None):
+		# Returns whatever is in the cache for a GET request, regardless of its
+		# age, or None. Never touches the network.
+		request = self._build_request("GET", url, query_params = query_params, postdata = None, headers = headers, max_age_secs = None, return_json = False, revalidate = None)
+		return self._cache_lookup(self._hash_request(request))
+
 
 if __name__ == "__main__":
 	cr = CachedRequests(cache_duration_secs = 10)
@@ -0,0 +1,154 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import time
+import math
+import json
+import bisect
+import threading
+import contextlib
+import collections
+
+class Histogram():
+	# Upper bounds of the buckets in seconds
+	_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+	def __init__(self):
+		self._counts = [ 0 ] * len(self._BUCKETS)
+		self._count = 0
+		self._sum = 0
+		self._min = None
+		self._max = None
+
+	@property
+	def count(self):
+		return self._count
+
+	@property
+	def sum(self):
+		return self._sum
+
+	@property
+	def max(self):
+		return self._max
+
+	def observe(self, value):
+		self._counts[bisect.bisect_left(self._BUCKETS, value)] += 1
+		self._count += 1
+		self._sum += value
+		self._min = value if (self._min is None) else min(self._min, value)
+		self._max = value if (self._max is None) else max(self._max, value)
+
+	def quantile(self, q):
+		# Estimated as the upper bound of the bucket the quantile falls into
+		if self._count == 0:
+			return None
+		threshold = q * self._count
+		cumulative = 0
+		for (upper_bound, count) in zip(self._BUCKETS, self._counts):
+			cumulative += count
+			if cumulative >= threshold:
+				return min(upper_bound, self._max)
+		return self._max
+
+	def cumulative_buckets(self):
+		cumulative = 0
+		for (upper_bound, count) in zip(self._BUCKETS, self._counts):
+			cumulative += count
+			yield (upper_bound, cumulative)
+
+	def to_dict(self):
+		return {
+			"count":		self._count,
+			"sum":			self._sum,
+			"min":			self._min,
+			"max":			self._max,
+			"p50":			self.quantile(0.5),
+			"p95":			self.quantile(0.95),
+			"buckets":		[ [ "+Inf" if (upper_bound == math.inf) else upper_bound, count ] for (upper_bound, count) in self.cumulative_buckets() ],
+		}
+
+class Metrics():
+	def __init__(self, prefix = "pybsaberdb"):
+		self._prefix = prefix
+		self._lock = threading.Lock()
+		self._counters = collections.Counter()
+		self._histograms = collections.defaultdict(Histogram)
+
+	def increment(self, name, amount = 1):
+		with self._lock:
+			self._counters[name] += amount
+
+	def observe(self, name, value):
+		with self._lock:
+			self._histograms[name].observe(value)
+
+	@contextlib.contextmanager
+	def timed(self, name):
+		t0 = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - t0)
+
+	def counter(self, name):
+		with self._lock:
+			return self._counters[name]
+
+	def to_dict(self):
+		with self._lock:
+			return {
+				"counters":		dict(self._counters),
+				"histograms":	{ name: histogram.to_dict() for (name, histogram) in self._histograms.items() },
+			}
+
+	def to_json(self):
+		return json.dumps(self.to_dict(), indent = 4, sort_keys = True)
+
+	def to_prometheus(self):
+		lines = [ ]
+		with self._lock:
+			for (name, value) in sorted(self._counters.items()):
+				lines.append("# TYPE %s_%s_total counter" % (self._prefix, name))
+				lines.append("%s_%s_total %s" % (self._prefix, name, value))
+			for (name, histogram) in sorted(self._histograms.items()):
+				lines.append("# TYPE %s_%s histogram" % (self._prefix, name))
+				for (upper_bound, count) in histogram.cumulative_buckets():
+					lines.append("%s_%s_bucket{le=\"%s\"} %d" % (self._prefix, name, "+Inf" if (upper_bound == math.inf) else repr(upper_bound), count))
+				lines.append("%s_%s_sum %f" % (self._prefix, name, histogram.sum))
+				lines.append("%s_%s_count %d" % (self._prefix, name, histogram.count))
+		return "\n".join(lines) + "\n"
+
+	def summary(self):
+		lines = [ ]
+		with self._lock:
+			counters = self._counters
+			lookups = counters["cache_hits"] + counters["cache_stale"] + counters["cache_misses"]
+			if lookups > 0:
+				lines.append("Cache: %d lookups, %d hits (%.1f%%), %d stale (%.1f%%, %d revalidated), %d misses (%.1f%%), %d coalesced" % (lookups, counters["cache_hits"], counters["cache_hits"] / lookups * 100, counters["cache_stale"], counters["cache_stale"] / lookups * 100, counters["cache_revalidated"], counters["cache_misses"], counters["cache_misses"] / lookups * 100, counters["coalesced_requests"]))
+			if (counters["network_bytes"] > 0) or (counters["cache_bytes"] > 0):
+				lines.append("Bytes: %.1f MiB transferred in %d requests, %.1f MiB served from cache" % (counters["network_bytes"] / 1024 / 1024, counters["network_requests"], counters["cache_bytes"] / 1024 / 1024))
+			if len(self._histograms) > 0:
+				lines.append("%-28s %8s %10s %10s %10s %10s %10s" % ("Phase", "count", "total", "mean", "p50", "p95", "max"))
+				for (name, histogram) in sorted(self._histograms.items(), key = lambda item: -item[1].sum):
+					lines.append("%-28s %8d %9.3fs %9.2fms %9.2fms %9.2fms %9.2fms" % (name, histogram.count, histogram.sum, histogram.sum / histogram.count * 1000, histogram.quantile(0.5) * 1000, histogram.quantile(0.95) * 1000, histogram.max * 1000))
+		return "\n".join(lines)
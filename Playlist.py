@@ -0,0 +1,264 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import json
+import contextlib
+
+class PlaylistWriter():
+	# Writes a Beat Saber .bplist playlist incrementally, one song at a time.
+	# The file only replaces an existing playlist once it is complete.
+	def __init__(self, filename, title, author = "pybsaberdb", image = None):
+		self._filename = filename
+		self._partial_filename = filename + ".part"
+		self._f = open(self._partial_filename, "w")
+		self._song_count = 0
+		header = { "playlistTitle": title, "playlistAuthor": author }
+		if image is not None:
+			header["image"] = image
+		# Everything up to the song list; the closing "}" is written at the end
+		self._f.write(json.dumps(header)[:-1] + ", \"songs\": [")
+
+	@property
+	def filename(self):
+		return self._filename
+
+	@property
+	def song_count(self):
+		return self._song_count
+
+	def add(self, song):
+		if self._song_count > 0:
+			self._f.write(",")
+		self._f.write("\n\t")
+		self._f.write(json.dumps({ "hash": song.song_hash, "key": song.song_key, "songName": song.title, "levelAuthorName": song.level_author }))
+		self._song_count += 1
+
+	def finish(self, custom_data = None):
+		# Completes the partial file without putting it in place yet
+		if not self._f.closed:
+			self._f.write("\n]")
+			if custom_data is not None:
+				self._f.write(", \"customData\": " + json.dumps(custom_data))
+			self._f.write("}\n")
+			self._f.close()
+
+	def close(self):
+		self.finish()
+		os.replace(self._partial_filename, self._filename)
+
+	def abort(self):
+		self._f.close()
+		os.unlink(self._partial_filename)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		if args[0] is None:
+			self.close()
+		else:
+			self.abort()
+
+class SplitPlaylistWriter():
+	# Splits songs into playlists of at most max_songs each. The first
+	# playlist is written to the given filename, subsequent ones get a
+	# numeric suffix (e.g., foo.bplist, foo_2.bplist, foo_3.bplist). No part
+	# replaces an existing playlist before all of them are complete.
+	def __init__(self, filename, title, author = "pybsaberdb", max_songs = None, limit = None, keep_filenames = None):
+		self._filename = filename
+		self._keep_filenames = set() if (keep_filenames is None) else set(keep_filenames)
+		self._title = title
+		self._author = author
+		self._max_songs = max_songs
+		self._limit = limit
+		self._song_count = 0
+		self._writers = [ ]
+		self._next_part()
+
+	@property
+	def filenames(self):
+		return [ writer.filename for writer in self._writers ]
+
+	@property
+	def song_count(self):
+		return self._song_count
+
+	@property
+	def full(self):
+		return (self._limit is not None) and (self._song_count >= self._limit)
+
+	@property
+	def _writer(self):
+		return self._writers[-1]
+
+	def _part(self, part):
+		if part == 1:
+			return (self._filename, self._title)
+		else:
+			(base, extension) = os.path.splitext(self._filename)
+			return ("%s_%d%s" % (base, part, extension), "%s (%d)" % (self._title, part))
+
+	def _next_part(self):
+		# The first part stays open until close() so that it can record the
+		# final number of parts
+		if len(self._writers) > 1:
+			self._writer.finish()
+		(filename, title) = self._part(len(self._writers) + 1)
+		if filename in self._keep_filenames:
+			raise ValueError("Part %d of playlist %s would overwrite the separate playlist %s." % (len(self._writers) + 1, self._filename, filename))
+		self._writers.append(PlaylistWriter(filename, title, author = self._author))
+
+	def add(self, song):
+		if self.full:
+			return False
+		if (self._max_songs is not None) and (self._writer.song_count >= self._max_songs):
+			self._next_part()
+		self._writer.add(song)
+		self._song_count += 1
+		return True
+
+	def _previous_part_count(self):
+		# The first part records how many parts were written last time; only
+		# those are ever removed again, never any other playlist that happens
+		# to share the name of a part
+		try:
+			with open(self._filename) as f:
+				return int(json.load(f)["customData"]["pybsaberdbParts"])
+		except (OSError, ValueError, TypeError, KeyError):
+			return 1
+
+	def close(self):
+		previous_part_count = self._previous_part_count()
+		self._writers[0].finish(custom_data = { "pybsaberdbParts": len(self._writers) })
+		for writer in self._writers:
+			writer.finish()
+		for writer in self._writers:
+			writer.close()
+		for part in range(len(self._writers) + 1, previous_part_count + 1):
+			(filename, title) = self._part(part)
+			if filename not in self._keep_filenames:
+				with contextlib.suppress(FileNotFoundError):
+					os.unlink(filename)
+
+	def abort(self):
+		for writer in self._writers:
+			writer.abort()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		if args[0] is None:
+			self.close()
+		else:
+			self.abort()
+
+def song_predicate(criteria):
+	# Returns a function that decides whether a Song matches the given
+	# search_songs() criteria in exactly the same way the database query
+	# would, or None if that is not possible (e.g., full text search or
+	# filters on indexed archives).
+	criteria = dict(criteria)
+	criteria.pop("limit", None)
+	if criteria.pop("order_by", "percentage") not in (None, "percentage"):
+		return None
+	checks = [ ]
+	for (name, value) in criteria.items():
+		if value is None:
+			continue
+		if name == "must_have_difficulties":
+			difficulties = frozenset(value)
+			checks.append(lambda song, difficulties = difficulties: difficulties <= song.difficulties)
+		elif name == "minimum_percentage":
+			checks.append(lambda song, value = value: song.percentage > value)
+		elif name == "minimum_votes":
+			checks.append(lambda song, value = value: song.total_votes > value)
+		elif name == "must_be_recommended":
+			if value:
+				checks.append(lambda song: song.recommended)
+		elif name == "include_categories":
+			checks.append(lambda song, value = value: song.includes_all_categories(value))
+		elif name == "exclude_categories":
+			checks.append(lambda song, value = value: not song.includes_any_category(value))
+		else:
+			return None
+	return lambda song: all(check(song) for check in checks)
+
+class PlaylistGenerator():
+	# Regenerates many saved queries at once: all queries that can be decided
+	# on a Song alone share a single pass over the database in rating order,
+	# only the remaining ones are run as separate queries.
+	def __init__(self, db, output_dir = ".", author = "pybsaberdb"):
+		self._db = db
+		self._output_dir = output_dir
+		self._author = author
+
+	def _filename(self, playlist):
+		return os.path.join(self._output_dir, playlist["name"] + ".bplist")
+
+	def _writer(self, playlist, filenames):
+		# Parts of a playlist must neither overwrite nor remove any other
+		# playlist of the same run
+		filename = self._filename(playlist)
+		return SplitPlaylistWriter(filename, playlist.get("title", playlist["name"]), author = self._author, max_songs = playlist.get("max_songs"), limit = playlist.get("criteria", { }).get("limit"), keep_filenames = filenames - { filename })
+
+	def generate(self, playlists):
+		# Returns a dictionary of playlist names to their writers
+		writers = { }
+		filenames = set(self._filename(playlist) for playlist in playlists)
+		single_pass = [ ]
+		separate = [ ]
+		for playlist in playlists:
+			predicate = song_predicate(playlist.get("criteria", { }))
+			if predicate is None:
+				separate.append(playlist)
+			else:
+				single_pass.append((playlist, predicate))
+
+		active = [ ]
+		try:
+			for (playlist, predicate) in single_pass:
+				writers[playlist["name"]] = self._writer(playlist, filenames)
+				active.append((writers[playlist["name"]], predicate))
+			if len(active) > 0:
+				for song in self._db.search_songs(order_by = "percentage"):
+					for (writer, predicate) in active:
+						if predicate(song):
+							writer.add(song)
+					if all(writer.full for (writer, predicate) in active):
+						break
+			for (writer, predicate) in active:
+				writer.close()
+		except:
+			for (writer, predicate) in active:
+				writer.abort()
+			raise
+
+		for playlist in separate:
+			criteria = dict(playlist.get("criteria", { }))
+			criteria.setdefault("order_by", "percentage")
+			with self._writer(playlist, filenames) as writer:
+				for song in self._db.search_songs(**criteria):
+					writer.add(song)
+			writers[playlist["name"]] = writer
+		return writers
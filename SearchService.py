@@ -0,0 +1,180 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import json
+import time
+import threading
+import collections
+import sqlite3
+import urllib.parse
+import http.server
+from SongDatabase import SongDatabase
+from Song import Song
+
+def _parse_bool(text):
+	if text.lower() in ( "1", "true", "yes" ):
+		return True
+	elif text.lower() in ( "0", "false", "no" ):
+		return False
+	else:
+		raise ValueError("not a boolean: %s" % (text))
+
+class SearchService():
+	# URL parameter: (search_songs argument, value type, may be repeated)
+	_PARAMETERS = {
+		"difficulty":			("must_have_difficulties", str, True),
+		"min_percentage":		("minimum_percentage", float, False),
+		"min_votes":			("minimum_votes", int, False),
+		"recommended":			("must_be_recommended", _parse_bool, False),
+		"include_category":		("include_categories", str, True),
+		"exclude_category":		("exclude_categories", str, True),
+		"title":				("song_title", str, True),
+		"author":				("level_author", str, True),
+		"min_bpm":				("minimum_bpm", float, False),
+		"max_bpm":				("maximum_bpm", float, False),
+		"min_nps":				("minimum_nps", float, False),
+		"max_nps":				("maximum_nps", float, False),
+		"min_duration":			("minimum_duration", float, False),
+		"max_duration":			("maximum_duration", float, False),
+		"order_by":				("order_by", str, False),
+		"limit":				("limit", int, False),
+	}
+
+	def __init__(self, dbfile = "beastsaber.sqlite3", cache_size = 1024, check_interval_secs = 1):
+		self._dbfile = dbfile
+		self._cache_size = cache_size
+		self._check_interval_secs = check_interval_secs
+		self._lock = threading.Lock()
+		self._cache = collections.OrderedDict()
+		self._statistics = collections.Counter()
+		# Only used to detect commits that other connections (i.e., a running
+		# mirror job) make to the database file
+		self._monitor = sqlite3.connect(dbfile, check_same_thread = False)
+		self._last_check = time.monotonic()
+		self._reload()
+
+	def _current_data_version(self):
+		return self._monitor.execute("PRAGMA data_version;").fetchone()[0]
+
+	def _reload(self):
+		# Determine the version before copying so that a commit that happens
+		# while copying causes another reload instead of being missed
+		data_version = self._current_data_version()
+		self._db = SongDatabase(self._dbfile, in_memory = True)
+		self._data_version = data_version
+		self._loaded_timet = time.time()
+		self._cache.clear()
+		self._statistics["reloads"] += 1
+
+	def _check_for_update(self):
+		now = time.monotonic()
+		if now - self._last_check < self._check_interval_secs:
+			return
+		self._last_check = now
+		if self._current_data_version() != self._data_version:
+			self._reload()
+
+	@classmethod
+	def parse_query(cls, query_string):
+		criteria = { "order_by": "percentage" }
+		for (name, values) in urllib.parse.parse_qs(query_string, keep_blank_values = True).items():
+			if name not in cls._PARAMETERS:
+				raise ValueError("unknown parameter: %s" % (name))
+			(argument, value_type, repeatable) = cls._PARAMETERS[name]
+			if (not repeatable) and (len(values) > 1):
+				raise ValueError("parameter may only be given once: %s" % (name))
+			values = [ value_type(value) for value in values ]
+			criteria[argument] = values if repeatable else values[0]
+		if any(difficulty not in Song.DIFFICULTIES for difficulty in criteria.get("must_have_difficulties", [ ])):
+			raise ValueError("difficulty must be one of %s" % (", ".join(Song.DIFFICULTIES)))
+		if criteria["order_by"] not in SongDatabase._ORDER_BY:
+			raise ValueError("order_by must be one of %s" % (", ".join(sorted(SongDatabase._ORDER_BY))))
+		return criteria
+
+	@staticmethod
+	def _normalize(criteria):
+		# Queries which only differ in the order of their parameters share the
+		# same cache entry
+		return tuple(sorted((argument, tuple(sorted(set(value))) if isinstance(value, list) else value) for (argument, value) in criteria.items()))
+
+	def search(self, criteria):
+		# Returns the JSON encoded result
+		key = self._normalize(criteria)
+		with self._lock:
+			self._check_for_update()
+			result = self._cache.get(key)
+			if result is not None:
+				self._cache.move_to_end(key)
+				self._statistics["cache_hits"] += 1
+				return result
+			self._statistics["cache_misses"] += 1
+			songs = [ song.to_dict() for song in self._db.search_songs(**criteria) ]
+			result = json.dumps({ "count": len(songs), "songs": songs }).encode("utf-8")
+			self._cache[key] = result
+			if len(self._cache) > self._cache_size:
+				self._cache.popitem(last = False)
+			return result
+
+	def status(self):
+		with self._lock:
+			self._check_for_update()
+			return {
+				"dbfile":				self._dbfile,
+				"loaded_timet":			self._loaded_timet,
+				"data_version":			self._data_version,
+				"cached_queries":		len(self._cache),
+				"statistics":			dict(self._statistics),
+			}
+
+class SearchRequestHandler(http.server.BaseHTTPRequestHandler):
+	def _send_json(self, status, content):
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def do_GET(self):
+		url = urllib.parse.urlsplit(self.path)
+		if url.path == "/search":
+			try:
+				criteria = self.server.service.parse_query(url.query)
+			except ValueError as e:
+				self._send_json(400, json.dumps({ "error": str(e) }).encode("utf-8"))
+				return
+			self._send_json(200, self.server.service.search(criteria))
+		elif url.path == "/status":
+			self._send_json(200, json.dumps(self.server.service.status()).encode("utf-8"))
+		else:
+			self._send_json(404, json.dumps({ "error": "not found: %s" % (url.path) }).encode("utf-8"))
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			super().log_message(format, *args)
+
+class SearchServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, service, address, verbose = False):
+		self.service = service
+		self.verbose = verbose
+		super().__init__(address, SearchRequestHandler)
@@ -20,18 +20,60 @@
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
 import json
+import sys
+
+_DIFFICULTIES = ( "easy", "normal", "hard", "expert", "expert+" )
 
 class Song():
+	DIFFICULTIES = _DIFFICULTIES
+	__slots__ = ( "_song_key", "_level_author", "_title", "_song_hash", "_difficulty_mask", "_recommended", "_thumbs_up", "_thumbs_down", "_categories_json", "_category_mask" )
+
+	# Every possible difficulty combination is a shared frozenset
+	_DIFFICULTY_SETS = tuple(frozenset(difficulty for (bit, difficulty) in enumerate(_DIFFICULTIES) if (mask & (1 << bit))) for mask in range(1 << len(_DIFFICULTIES)))
+
+	# Category names are interned into process-wide bit numbers
+	_CATEGORY_BITS = { }
+	_CATEGORY_NAMES = [ ]
+	_CATEGORY_SETS = { }
+
 	def __init__(self, song_key, level_author, title, song_hash, difficulties, recommended, thumbs_up, thumbs_down, categories):
 		self._song_key = song_key
 		self._level_author = level_author
 		self._title = title
 		self._song_hash = song_hash
-		self._difficulties = difficulties
+		self._difficulty_mask = self.difficulty_mask_of(difficulties)
 		self._recommended = recommended
 		self._thumbs_up = thumbs_up
 		self._thumbs_down = thumbs_down
-		self._categories = categories
+		self._categories_json = None
+		self._category_mask = self._intern_categories(categories)
+
+	@classmethod
+	def difficulty_mask_of(cls, difficulties):
+		return sum(1 << cls.DIFFICULTIES.index(difficulty) for difficulty in set(difficulties))
+
+	@classmethod
+	def _intern_categories(cls, categories):
+		mask = 0
+		for category in categories:
+			bit = cls._CATEGORY_BITS.get(category)
+			if bit is None:
+				bit = len(cls._CATEGORY_NAMES)
+				cls._CATEGORY_NAMES.append(sys.intern(category))
+				cls._CATEGORY_BITS[category] = bit
+			mask |= 1 << bit
+		return mask
+
+	@classmethod
+	def _known_category_mask(cls, categories):
+		# Returns None if any of the categories has never been seen
+		mask = 0
+		for category in categories:
+			bit = cls._CATEGORY_BITS.get(category)
+			if bit is None:
+				return None
+			mask |= 1 << bit
+		return mask
 
 	@property
 	def song_key(self):
@@ -49,9 +91,13 @@ class Song():
 	def song_hash(self):
 		return self._song_hash
 
+	@property
+	def difficulty_mask(self):
+		return self._difficulty_mask
+
 	@property
 	def difficulties(self):
-		return self._difficulties
+		return self._DIFFICULTY_SETS[self._difficulty_mask]
 
 	@property
 	def recommended(self):
@@ -65,9 +111,22 @@ class Song():
 	def thumbs_down(self):
 		return self._thumbs_down
 
+	@property
+	def category_mask(self):
+		if self._category_mask is None:
+			# Categories are only decoded when they're first needed
+			self._category_mask = self._intern_categories(json.loads(self._categories_json))
+			self._categories_json = None
+		return self._category_mask
+
 	@property
 	def categories(self):
-		return self._categories
+		mask = self.category_mask
+		categories = self._CATEGORY_SETS.get(mask)
+		if categories is None:
+			categories = frozenset(name for (bit, name) in enumerate(self._CATEGORY_NAMES) if (mask & (1 << bit)))
+			self._CATEGORY_SETS[mask] = categories
+		return categories
 
 	@property
 	def total_votes(self):
@@ -87,6 +146,16 @@ class Song():
 		else:
 			return (self.thumbs_up + 1) / (self.total_votes + 2) * 100
 
+	@classmethod
+	def from_row(cls, row):
+		# Row layout: song_key, level_author, title, hash, difficulty bitmask,
+		# recommended, thumbs_up, thumbs_down, categories_json
+		song = cls.__new__(cls)
+		(song._song_key, song._level_author, song._title, song._song_hash, song._difficulty_mask, recommended, song._thumbs_up, song._thumbs_down, song._categories_json) = row
+		song._recommended = bool(recommended)
+		song._category_mask = None
+		return song
+
 	@classmethod
 	def from_rowdict(cls, rowdict):
 		difficulties = set()
@@ -104,15 +173,34 @@ class Song():
 		return cls(song_key = rowdict["song_key"], level_author = rowdict["level_author"], title = rowdict["title"], song_hash = rowdict["hash"], difficulties = difficulties, recommended = bool(rowdict["recommended"]), thumbs_up = rowdict["thumbs_up"], thumbs_down = rowdict["thumbs_down"], categories = categories)
 
 	def includes_all_categories(self, categories):
-		return all(category in self.categories for category in categories)
+		# Decode own categories first so that their names are interned
+		category_mask = self.category_mask
+		mask = self._known_category_mask(categories)
+		return (mask is not None) and ((category_mask & mask) == mask)
 
 	def includes_any_category(self, categories):
-		return any(category in self.categories for category in categories)
+		category_mask = self.category_mask
+		return any(((category_mask >> self._CATEGORY_BITS[category]) & 1) for category in categories if (category in self._CATEGORY_BITS))
 
 	@property
 	def download_url(self):
 		return "https://beatsaver.com/cdn/%s/%s.zip" % (self.song_key, self.song_hash)
 
+	def to_dict(self):
+		return {
+			"song_key":			self.song_key,
+			"level_author":		self.level_author,
+			"title":			self.title,
+			"hash":				self.song_hash,
+			"difficulties":		[ difficulty for difficulty in self.DIFFICULTIES if (difficulty in self.difficulties) ],
+			"recommended":		self.recommended,
+			"thumbs_up":		self.thumbs_up,
+			"thumbs_down":		self.thumbs_down,
+			"percentage":		self.percentage,
+			"categories":		sorted(self.categories),
+			"download_url":		self.download_url,
+		}
+
 	def __str__(self):
 		if len(self.categories) == 0:
 			category_str = "/"
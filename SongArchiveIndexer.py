@@ -0,0 +1,135 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import re
+import json
+import zipfile
+import hashlib
+
+class SongArchiveIndexer():
+	_HASH_RE = re.compile(r"[0-9a-fA-F]{40}")
+	_OGG_TAIL_SIZE = 64 * 1024
+
+	def __init__(self, filename):
+		self._filename = filename
+		self._zf = None
+
+	def _open_member(self, name):
+		# Archive member names are not consistently capitalized ("Info.dat"
+		# vs. "info.dat")
+		for member_name in self._zf.namelist():
+			if member_name.lower() == name.lower():
+				return self._zf.open(member_name)
+		raise KeyError("No member %s in %s" % (name, self._filename))
+
+	def _read_member(self, name):
+		with self._open_member(name) as f:
+			return f.read()
+
+	def _audio_duration(self, audio_filename):
+		# Ogg/Vorbis: the sample rate is in the identification header at the
+		# start of the stream and the granule position of the last page is the
+		# total number of samples
+		with self._open_member(audio_filename) as f:
+			head = f.read(4096)
+			tail = head
+			while True:
+				chunk = f.read(self._OGG_TAIL_SIZE)
+				if len(chunk) == 0:
+					break
+				tail = tail[-self._OGG_TAIL_SIZE:] + chunk
+		vorbis_header = head.find(b"\x01vorbis")
+		last_page = tail.rfind(b"OggS")
+		if (vorbis_header == -1) or (last_page == -1) or (len(tail) < last_page + 14):
+			return None
+		sample_rate = int.from_bytes(head[vorbis_header + 12 : vorbis_header + 16], "little")
+		granule_position = int.from_bytes(tail[last_page + 6 : last_page + 14], "little")
+		if sample_rate == 0:
+			return None
+		return granule_position / sample_rate
+
+	@staticmethod
+	def _count_objects(beatmap):
+		if "_notes" in beatmap:
+			# Beatmap format v2: notes of type 3 are bombs
+			notes = sum(1 for note in beatmap["_notes"] if note.get("_type") != 3)
+			bombs = len(beatmap["_notes"]) - notes
+			obstacles = len(beatmap.get("_obstacles", [ ]))
+		else:
+			# Beatmap format v3
+			notes = len(beatmap.get("colorNotes", [ ])) + len(beatmap.get("burstSliders", [ ]))
+			bombs = len(beatmap.get("bombNotes", [ ]))
+			obstacles = len(beatmap.get("obstacles", [ ]))
+		return (notes, bombs, obstacles)
+
+	def _index(self):
+		info_data = self._read_member("info.dat")
+		info = json.loads(info_data)
+		try:
+			duration_secs = self._audio_duration(info["_songFilename"])
+		except KeyError:
+			duration_secs = None
+
+		difficulties = [ ]
+		beatmap_data = [ ]
+		for beatmap_set in info.get("_difficultyBeatmapSets", [ ]):
+			for difficulty_beatmap in beatmap_set.get("_difficultyBeatmaps", [ ]):
+				data = self._read_member(difficulty_beatmap["_beatmapFilename"])
+				beatmap_data.append(data)
+				(notes, bombs, obstacles) = self._count_objects(json.loads(data))
+				difficulties.append({
+					"characteristic":		beatmap_set.get("_beatmapCharacteristicName", "Standard"),
+					"difficulty":			difficulty_beatmap["_difficulty"],
+					"note_count":			notes,
+					"bomb_count":			bombs,
+					"obstacle_count":		obstacles,
+					"notes_per_second":		(notes / duration_secs) if duration_secs else None,
+				})
+
+		# Archives downloaded by searchbeastsaber are named after their hash;
+		# otherwise derive it the same way BeatSaver does
+		stem = os.path.splitext(os.path.basename(self._filename))[0]
+		if self._HASH_RE.fullmatch(stem):
+			song_hash = stem
+		else:
+			song_hash = hashlib.sha1(info_data + b"".join(beatmap_data)).hexdigest()
+
+		return {
+			"hash":				song_hash,
+			"song_name":		info.get("_songName"),
+			"song_author":		info.get("_songAuthorName"),
+			"bpm":				info.get("_beatsPerMinute"),
+			"duration_secs":	duration_secs,
+			"difficulties":		difficulties,
+		}
+
+	def index(self):
+		with zipfile.ZipFile(self._filename) as self._zf:
+			return self._index()
+
+def index_song_archive(filename):
+	try:
+		return (filename, SongArchiveIndexer(filename).index())
+	except Exception as e:
+		# Any malformed archive must only fail itself, not the whole pool
+		return (filename, e)
@@ -0,0 +1,447 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import sqlite3
+import contextlib
+import json
+import urllib.parse
+from Song import Song
+from SongSnapshot import SnapshotWriter, SnapshotReader
+
+class SongDatabase():
+	# Same as Song.percentage
+	_PERCENTAGE_EXPRESSION = "CASE WHEN thumbs_up + thumbs_down > 0 THEN 100.0 * (thumbs_up + 1) / (thumbs_up + thumbs_down + 2) ELSE 0 END"
+	_ORDER_BY = {
+		"percentage":	"percentage DESC, songs.id DESC",
+		"votes":		"total_votes DESC",
+		"title":		"title ASC",
+		"relevance":	"fts_rank ASC, percentage DESC, songs.id DESC",
+	}
+	# Bitmask in the order of Song.DIFFICULTIES
+	_DIFFICULTY_MASK_EXPRESSION = "(COALESCE(difficulty_easy, 0) << 0) | (COALESCE(difficulty_normal, 0) << 1) | (COALESCE(difficulty_hard, 0) << 2) | (COALESCE(difficulty_expert, 0) << 3) | (COALESCE(difficulty_expertplus, 0) << 4)"
+	# Row layout expected by Song.from_row()
+	_SONG_COLUMNS = "song_key, level_author, title, hash, %s, recommended, thumbs_up, thumbs_down, categories_json" % (_DIFFICULTY_MASK_EXPRESSION)
+	_ARCHIVE_DIFFICULTY_NAMES = {
+		"easy":			"Easy",
+		"normal":		"Normal",
+		"hard":			"Hard",
+		"expert":		"Expert",
+		"expert+":		"ExpertPlus",
+	}
+	# Indices on the song tables which are dropped while bulk loading
+	_SONG_INDICES = {
+		"songs_percentage_idx":					"songs(percentage) WHERE metadata_update_timet IS NOT NULL",
+		"songs_total_votes_idx":				"songs(total_votes) WHERE metadata_update_timet IS NOT NULL",
+		"songs_recommended_percentage_idx":		"songs(recommended, percentage) WHERE metadata_update_timet IS NOT NULL",
+		"song_categories_song_idx":				"song_categories(song_id)",
+	}
+	_FTS_TRIGGERS = {
+		"songs_fts_insert":		"AFTER INSERT ON songs BEGIN INSERT INTO songs_fts (rowid, title, level_author) VALUES (new.id, new.title, new.level_author); END",
+		"songs_fts_delete":		"AFTER DELETE ON songs BEGIN INSERT INTO songs_fts (songs_fts, rowid, title, level_author) VALUES ('delete', old.id, old.title, old.level_author); END",
+		"songs_fts_update":		"AFTER UPDATE OF title, level_author ON songs BEGIN INSERT INTO songs_fts (songs_fts, rowid, title, level_author) VALUES ('delete', old.id, old.title, old.level_author); INSERT INTO songs_fts (rowid, title, level_author) VALUES (new.id, new.title, new.level_author); END",
+	}
+	# Everything _create_schema() creates; used to tell whether a database
+	# needs to be upgraded
+	_SCHEMA_OBJECTS = ( "songs", "categories", "song_categories", "songs_fts", "archives", "archive_difficulties", "archive_failures", "refresh_queue" ) + tuple(_SONG_INDICES) + tuple(_FTS_TRIGGERS)
+	_SCHEMA_SONG_COLUMNS = ( "total_votes", "percentage", "vote_velocity", "details_failures", "rating_failures" )
+	# Tables (and the order in which they're loaded) of a snapshot
+	_SNAPSHOT_TABLES = ( "categories", "songs", "song_categories" )
+
+	def __init__(self, dbfile = "beastsaber.sqlite3", in_memory = False, read_only = False, immutable = False):
+		if in_memory:
+			# Work on a private copy of the database that is held in memory
+			source = self._connect_read_only(dbfile)
+			self._db = sqlite3.connect(":memory:", check_same_thread = False)
+			source.backup(self._db)
+			source.close()
+		elif read_only:
+			self._db = self._connect_read_only(dbfile, immutable = immutable)
+			if not self._schema_is_current(self._db):
+				# Databases written by older versions need to be upgraded once
+				# before they can be used read-only
+				self._db.close()
+				with contextlib.suppress(sqlite3.OperationalError):
+					SongDatabase(dbfile).close()
+				self._db = self._connect_read_only(dbfile, immutable = immutable)
+				if not self._schema_is_current(self._db):
+					raise sqlite3.OperationalError("Database %s predates the current schema and cannot be upgraded when opened read-only; run mirror_database on it once first." % (dbfile))
+		else:
+			self._db = sqlite3.connect(dbfile)
+		self._cursor = self._db.cursor()
+		self._category_id_cache = { }
+		if in_memory or (not read_only):
+			self._create_schema()
+
+	@staticmethod
+	def _connect_read_only(dbfile, immutable = False):
+		# An immutable database is opened without any locking at all, which is
+		# only safe if no mirror job writes to it concurrently. It also ignores
+		# the write-ahead log, so commits which have not been checkpointed
+		# (e.g., after a crashed mirror job) would silently be missing.
+		uri = "file:%s?mode=ro" % (urllib.parse.quote(os.path.abspath(dbfile)))
+		if immutable:
+			with contextlib.suppress(FileNotFoundError):
+				if os.stat(dbfile + "-wal").st_size > 0:
+					raise sqlite3.OperationalError("Database %s has a non-empty write-ahead log and cannot be opened immutable; checkpoint it first (PRAGMA wal_checkpoint(TRUNCATE)) or open it read-only without immutable." % (dbfile))
+			uri += "&immutable=1"
+		return sqlite3.connect(uri, uri = True)
+
+	@classmethod
+	def _schema_is_current(cls, db):
+		names = set(row[0] for row in db.execute("SELECT name FROM sqlite_master;").fetchall())
+		if any(name not in names for name in cls._SCHEMA_OBJECTS):
+			return False
+		# Generated columns are only reported by table_xinfo
+		song_columns = set(row[1] for row in db.execute("PRAGMA table_xinfo(songs);").fetchall())
+		return all(column in song_columns for column in cls._SCHEMA_SONG_COLUMNS)
+
+	def close(self):
+		self._db.close()
+
+	def _create_schema(self):
+		self._cursor.execute("PRAGMA journal_mode = WAL;")
+		self._cursor.execute("PRAGMA synchronous = NORMAL;")
+
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("""
+				CREATE TABLE songs (
+					id integer NOT NULL PRIMARY KEY,
+					song_key varchar NOT NULL UNIQUE,
+					level_author varchar NOT NULL,
+					title varchar NOT NULL,
+					hash varchar NOT NULL,
+					rating_update_timet float NULL,
+					rating_fun float NULL,
+					rating_rhythm float NULL,
+					rating_flow float NULL,
+					rating_pattern_quality float NULL,
+					rating_readability float NULL,
+					rating_level_quality float NULL,
+					metadata_update_timet float NULL,
+					difficulty_easy boolean NULL,
+					difficulty_normal boolean NULL,
+					difficulty_hard boolean NULL,
+					difficulty_expert boolean NULL,
+					difficulty_expertplus boolean NULL,
+					recommended boolean NULL,
+					thumbs_up integer NULL,
+					thumbs_down integer NULL,
+					categories_json varchar NULL,
+					vote_velocity float NULL,
+					details_failed_timet float NULL,
+					details_failures integer NOT NULL DEFAULT 0,
+					rating_failed_timet float NULL,
+					rating_failures integer NOT NULL DEFAULT 0,
+					total_votes integer GENERATED ALWAYS AS (thumbs_up + thumbs_down) VIRTUAL,
+					percentage float GENERATED ALWAYS AS (%s) VIRTUAL
+				);
+			""" % (self._PERCENTAGE_EXPRESSION))
+		with contextlib.suppress(sqlite3.OperationalError):
+			# Upgrade databases which predate the generated score columns
+			self._cursor.execute("ALTER TABLE songs ADD COLUMN total_votes integer GENERATED ALWAYS AS (thumbs_up + thumbs_down) VIRTUAL;")
+			self._cursor.execute("ALTER TABLE songs ADD COLUMN percentage float GENERATED ALWAYS AS (%s) VIRTUAL;" % (self._PERCENTAGE_EXPRESSION))
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("ALTER TABLE songs ADD COLUMN vote_velocity float NULL;")
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("ALTER TABLE songs ADD COLUMN details_failed_timet float NULL;")
+			self._cursor.execute("ALTER TABLE songs ADD COLUMN details_failures integer NOT NULL DEFAULT 0;")
+			self._cursor.execute("ALTER TABLE songs ADD COLUMN rating_failed_timet float NULL;")
+			self._cursor.execute("ALTER TABLE songs ADD COLUMN rating_failures integer NOT NULL DEFAULT 0;")
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("""
+				CREATE TABLE categories (
+					id integer NOT NULL PRIMARY KEY,
+					name varchar NOT NULL UNIQUE
+				);
+			""")
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("""
+				CREATE TABLE song_categories (
+					song_id integer NOT NULL REFERENCES songs(id),
+					category_id integer NOT NULL REFERENCES categories(id),
+					PRIMARY KEY (category_id, song_id)
+				) WITHOUT ROWID;
+			""")
+			self._cursor.execute("CREATE INDEX song_categories_song_idx ON song_categories(song_id);")
+			# Populate the category index from databases which predate it
+			self._store_song_categories(self._cursor.execute("SELECT song_key, categories_json FROM songs WHERE categories_json IS NOT NULL;").fetchall())
+		self._create_song_indices()
+		with contextlib.suppress(sqlite3.OperationalError):
+			# Full text index over title and level author which is kept in sync
+			# with the songs table by triggers
+			self._cursor.execute("CREATE VIRTUAL TABLE songs_fts USING fts5(title, level_author, content = 'songs', content_rowid = 'id');")
+			self._create_fts_triggers()
+			self._cursor.execute("INSERT INTO songs_fts (songs_fts) VALUES ('rebuild');")
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("""
+				CREATE TABLE archives (
+					hash varchar NOT NULL PRIMARY KEY,
+					filename varchar NOT NULL UNIQUE,
+					file_size integer NOT NULL,
+					file_mtime float NOT NULL,
+					index_timet float NOT NULL,
+					song_name varchar NULL,
+					song_author varchar NULL,
+					bpm float NULL,
+					duration_secs float NULL
+				);
+			""")
+			self._cursor.execute("CREATE INDEX archives_bpm_idx ON archives(bpm);")
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("""
+				CREATE TABLE archive_difficulties (
+					hash varchar NOT NULL REFERENCES archives(hash),
+					characteristic varchar NOT NULL,
+					difficulty varchar NOT NULL,
+					note_count integer NOT NULL,
+					bomb_count integer NOT NULL,
+					obstacle_count integer NOT NULL,
+					notes_per_second float NULL,
+					PRIMARY KEY (hash, characteristic, difficulty)
+				);
+			""")
+			self._cursor.execute("CREATE INDEX archive_difficulties_nps_idx ON archive_difficulties(notes_per_second);")
+		with contextlib.suppress(sqlite3.OperationalError):
+			# Archives which could not be indexed; they're only retried once
+			# they've changed
+			self._cursor.execute("""
+				CREATE TABLE archive_failures (
+					filename varchar NOT NULL PRIMARY KEY,
+					file_size integer NOT NULL,
+					file_mtime float NOT NULL,
+					index_timet float NOT NULL,
+					error varchar NOT NULL
+				);
+			""")
+		with contextlib.suppress(sqlite3.OperationalError):
+			self._cursor.execute("""
+				CREATE TABLE refresh_queue (
+					id integer NOT NULL PRIMARY KEY,
+					song_key varchar NOT NULL,
+					kind varchar NOT NULL,
+					priority float NOT NULL,
+					UNIQUE (song_key, kind)
+				);
+			""")
+		self._db.commit()
+
+	def _create_song_indices(self):
+		for (name, definition) in self._SONG_INDICES.items():
+			self._cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s;" % (name, definition))
+
+	def _drop_song_indices(self):
+		for name in self._SONG_INDICES:
+			self._cursor.execute("DROP INDEX IF EXISTS %s;" % (name))
+
+	def _create_fts_triggers(self):
+		for (name, definition) in self._FTS_TRIGGERS.items():
+			self._cursor.execute("CREATE TRIGGER IF NOT EXISTS %s %s;" % (name, definition))
+
+	def _drop_fts_triggers(self):
+		for name in self._FTS_TRIGGERS:
+			self._cursor.execute("DROP TRIGGER IF EXISTS %s;" % (name))
+
+	def _table_columns(self, table):
+		# Generated columns are not reported by table_info
+		return [ row[1] for row in self._cursor.execute("PRAGMA table_info(%s);" % (table)).fetchall() ]
+
+	def export_snapshot(self, f):
+		writer = SnapshotWriter(f)
+		# Read all tables within one transaction so they're consistent
+		self._db.commit()
+		self._cursor.execute("BEGIN;")
+		try:
+			for table in self._SNAPSHOT_TABLES:
+				columns = self._table_columns(table)
+				order = "category_id, song_id" if (table == "song_categories") else "id"
+				writer.write_table(table, columns, self._db.execute("SELECT %s FROM %s ORDER BY %s;" % (", ".join(columns), table, order)))
+		finally:
+			self._db.commit()
+		writer.finish()
+		return writer.row_counts
+
+	def import_snapshot(self, f):
+		reader = SnapshotReader(f)
+		self.bulk_load(reader.read())
+		return reader.row_counts
+
+	def bulk_load(self, row_groups):
+		# Replaces all songs and categories by the given (table, columns,
+		# rows) row groups. Indices and full text search triggers are removed
+		# during the load and rebuilt afterwards, all within a single
+		# transaction.
+		self._db.commit()
+		self._cursor.execute("BEGIN;")
+		try:
+			self._drop_song_indices()
+			self._drop_fts_triggers()
+			for table in self._SNAPSHOT_TABLES:
+				self._cursor.execute("DELETE FROM %s;" % (table))
+			table_columns = { table: set(self._table_columns(table)) for table in self._SNAPSHOT_TABLES }
+			for (table, columns, rows) in row_groups:
+				if table not in table_columns:
+					continue
+				# Columns which this version of the schema does not know about
+				# are skipped
+				selected = [ index for (index, column) in enumerate(columns) if column in table_columns[table] ]
+				sql = "INSERT INTO %s (%s) VALUES (%s);" % (table, ", ".join(columns[index] for index in selected), ", ".join("?" for index in selected))
+				if len(selected) == len(columns):
+					self._cursor.executemany(sql, rows)
+				else:
+					self._cursor.executemany(sql, ([ row[index] for index in selected ] for row in rows))
+			self._create_song_indices()
+			self._create_fts_triggers()
+			self._cursor.execute("INSERT INTO songs_fts (songs_fts) VALUES ('rebuild');")
+		except:
+			self._db.rollback()
+			raise
+		self._db.commit()
+		self._category_id_cache = { }
+
+	def _category_ids(self, names):
+		result = [ ]
+		for name in names:
+			if name not in self._category_id_cache:
+				self._cursor.execute("INSERT OR IGNORE INTO categories (name) VALUES (?);", (name, ))
+				(self._category_id_cache[name], ) = self._cursor.execute("SELECT id FROM categories WHERE name = ?;", (name, )).fetchone()
+			result.append(self._category_id_cache[name])
+		return result
+
+	def _store_song_categories(self, song_categories):
+		for (song_key, categories_json) in song_categories:
+			(song_id, ) = self._cursor.execute("SELECT id FROM songs WHERE song_key = ?;", (song_key, )).fetchone()
+			self._cursor.execute("DELETE FROM song_categories WHERE song_id = ?;", (song_id, ))
+			self._cursor.executemany("INSERT INTO song_categories (song_id, category_id) VALUES (?, ?);", ((song_id, category_id) for category_id in self._category_ids(json.loads(categories_json))))
+
+	def _existing_category_ids(self, names):
+		result = [ ]
+		for name in names:
+			row = self._cursor.execute("SELECT id FROM categories WHERE name = ?;", (name, )).fetchone()
+			result.append(row[0] if (row is not None) else None)
+		return result
+
+	@staticmethod
+	def _fts_prefix_query(column, words):
+		# Every word has to match a token (or token prefix) in the given
+		# column; words without any indexable characters cannot be matched
+		# and are ignored.
+		return [ "%s : \"%s\" *" % (column, word.replace("\"", "\"\"")) for word in words if any(char.isalnum() for char in word) ]
+
+	def search_songs(self, must_have_difficulties = None, minimum_percentage = None, minimum_votes = None, must_be_recommended = False, include_categories = None, exclude_categories = None, song_title = None, level_author = None, minimum_bpm = None, maximum_bpm = None, minimum_duration = None, maximum_duration = None, minimum_nps = None, maximum_nps = None, order_by = None, limit = None):
+		where = set()
+		params = { }
+		where.add("metadata_update_timet IS NOT NULL")
+		if minimum_votes is not None:
+			where.add("total_votes > %d" % (minimum_votes))
+		if minimum_percentage is not None:
+			where.add("percentage > %f" % (minimum_percentage))
+		if must_have_difficulties is not None:
+			if "easy" in must_have_difficulties:
+				where.add("difficulty_easy = 1")
+			if "normal" in must_have_difficulties:
+				where.add("difficulty_normal = 1")
+			if "hard" in must_have_difficulties:
+				where.add("difficulty_hard = 1")
+			if "expert" in must_have_difficulties:
+				where.add("difficulty_expert = 1")
+			if "expert+" in must_have_difficulties:
+				where.add("difficulty_expertplus = 1")
+		if must_be_recommended:
+			where.add("recommended = 1")
+		if include_categories is not None:
+			for category_id in self._existing_category_ids(include_categories):
+				if category_id is None:
+					# Category is not known at all, nothing can match
+					where.add("0")
+				else:
+					where.add("songs.id IN (SELECT song_id FROM song_categories WHERE category_id = %d)" % (category_id))
+		if exclude_categories is not None:
+			category_ids = [ category_id for category_id in self._existing_category_ids(exclude_categories) if category_id is not None ]
+			if len(category_ids) > 0:
+				where.add("songs.id NOT IN (SELECT song_id FROM song_categories WHERE category_id IN (%s))" % (", ".join("%d" % (category_id) for category_id in category_ids)))
+		fts_query = [ ]
+		if song_title is not None:
+			fts_query += self._fts_prefix_query("title", song_title)
+		if level_author is not None:
+			fts_query += self._fts_prefix_query("level_author", level_author)
+		# Filters on locally indexed song archives
+		archive_where = set()
+		if minimum_bpm is not None:
+			archive_where.add("bpm >= :minimum_bpm")
+			params["minimum_bpm"] = minimum_bpm
+		if maximum_bpm is not None:
+			archive_where.add("bpm <= :maximum_bpm")
+			params["maximum_bpm"] = maximum_bpm
+		if minimum_duration is not None:
+			archive_where.add("duration_secs >= :minimum_duration")
+			params["minimum_duration"] = minimum_duration
+		if maximum_duration is not None:
+			archive_where.add("duration_secs <= :maximum_duration")
+			params["maximum_duration"] = maximum_duration
+		if len(archive_where) > 0:
+			where.add("songs.hash IN (SELECT hash FROM archives WHERE %s)" % (" AND ".join(sorted(archive_where))))
+		difficulty_where = set()
+		if minimum_nps is not None:
+			difficulty_where.add("notes_per_second >= :minimum_nps")
+			params["minimum_nps"] = minimum_nps
+		if maximum_nps is not None:
+			difficulty_where.add("notes_per_second <= :maximum_nps")
+			params["maximum_nps"] = maximum_nps
+		if len(difficulty_where) > 0:
+			if must_have_difficulties is not None:
+				# NPS needs to match one of the requested difficulties
+				difficulty_where.add("difficulty IN (%s)" % (", ".join("'%s'" % (self._ARCHIVE_DIFFICULTY_NAMES[difficulty]) for difficulty in must_have_difficulties)))
+			where.add("songs.hash IN (SELECT hash FROM archive_difficulties WHERE %s)" % (" AND ".join(sorted(difficulty_where))))
+
+		from_clause = "songs"
+		if len(fts_query) > 0:
+			from_clause += " JOIN (SELECT rowid AS fts_rowid, rank AS fts_rank FROM songs_fts WHERE songs_fts MATCH :fts_query) ON fts_rowid = songs.id"
+			params["fts_query"] = " AND ".join(fts_query)
+		elif order_by == "relevance":
+			# Without any words to match, everything is equally relevant and
+			# the rating decides
+			order_by = "percentage"
+		where_clause = "WHERE " + (" AND ".join(sorted("(%s)" % (clause) for clause in where)))
+		order_clause = "" if (order_by is None) else (" ORDER BY %s" % (self._ORDER_BY[order_by]))
+		limit_clause = "" if (limit is None) else (" LIMIT %d" % (limit))
+		sql = "SELECT %s FROM %s %s%s%s;" % (self._SONG_COLUMNS, from_clause, where_clause, order_clause, limit_clause)
+		for row in self._db.execute(sql, params):
+			yield Song.from_row(row)
+
+	def get_songs_by_id(self, song_ids):
+		song_ids = [ int(song_id) for song_id in song_ids ]
+		if len(song_ids) == 0:
+			return [ ]
+		sql = "SELECT id, %s FROM songs WHERE id IN (%s);" % (self._SONG_COLUMNS, ", ".join("%d" % (song_id) for song_id in song_ids))
+		songs = { row[0]: Song.from_row(row[1:]) for row in self._cursor.execute(sql).fetchall() }
+		return [ songs[song_id] for song_id in song_ids ]
+
+	def get_ranking_columns(self):
+		# Per song: id, thumbs up/down, the six ratings and the difficulties
+		# as a bitmask
+		return self._cursor.execute("SELECT id, thumbs_up, thumbs_down, recommended, rating_fun, rating_rhythm, rating_flow, rating_pattern_quality, rating_readability, rating_level_quality, %s FROM songs WHERE metadata_update_timet IS NOT NULL ORDER BY id ASC;" % (self._DIFFICULTY_MASK_EXPRESSION)).fetchall()
+
+	def get_categories(self):
+		return dict(self._cursor.execute("SELECT name, id FROM categories;").fetchall())
+
+	def get_song_category_links(self):
+		return self._cursor.execute("SELECT song_id, category_id FROM song_categories;").fetchall()
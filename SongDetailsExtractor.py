@@ -0,0 +1,85 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+from lxml import etree
+
+class SongDetailsExtractor():
+	_CHUNK_SIZE = 16 * 1024
+	_XPATH_TEXT = etree.XPath("text()")
+	_XPATH_CATEGORIES = etree.XPath("a/text()")
+	_XPATH_ICON = etree.XPath("i")
+
+	def __init__(self, content):
+		self._content = content
+		self._difficulties = [ ]
+		self._categories = [ ]
+		self._thumbs_up_down = [ ]
+		self._recommended = False
+
+	def _handle_element(self, element):
+		# Returns True once the song's post has been completely seen
+		classname = element.get("class")
+		if element.tag == "a":
+			if classname == "post-difficulty":
+				self._difficulties += self._XPATH_TEXT(element)
+		elif element.tag == "span":
+			if classname == "bsaber-categories":
+				self._categories += self._XPATH_CATEGORIES(element)
+			elif classname == "post-stat":
+				self._thumbs_up_down.append(element)
+		elif element.tag == "div":
+			if classname == "post-recommended bsaber-tooltip -recommended":
+				self._recommended = True
+		elif element.tag == "article":
+			return len(self._thumbs_up_down) >= 2
+		return False
+
+	def _parse(self):
+		# Parse incrementally and stop as soon as the post itself has been
+		# processed; the comments, sidebar and footer that follow are never
+		# parsed.
+		parser = etree.HTMLPullParser(events = ("end", ))
+		for offset in range(0, len(self._content), self._CHUNK_SIZE):
+			parser.feed(self._content[offset : offset + self._CHUNK_SIZE])
+			for (event, element) in parser.read_events():
+				if self._handle_element(element):
+					return
+		parser.close()
+		for (event, element) in parser.read_events():
+			self._handle_element(element)
+
+	def extract(self):
+		self._parse()
+		assert(self._XPATH_ICON(self._thumbs_up_down[0])[0].get("class") == "fa fa-thumbs-up fa-fw")
+		assert(self._XPATH_ICON(self._thumbs_up_down[1])[0].get("class") == "fa fa-thumbs-down fa-fw")
+		thumbs_up = int("".join(self._XPATH_TEXT(self._thumbs_up_down[0])).strip())
+		thumbs_down = int("".join(self._XPATH_TEXT(self._thumbs_up_down[1])).strip())
+		return {
+			"difficulties": set(difficulty.lower() for difficulty in self._difficulties),
+			"categories":	set(category.lower() for category in self._categories),
+			"thumbs_up":	thumbs_up,
+			"thumbs_down":	thumbs_down,
+			"recommended":	self._recommended,
+		}
+
+def extract_song_details(content):
+	return SongDetailsExtractor(content).extract()
@@ -0,0 +1,129 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import numpy
+from Song import Song
+
+class SongRanking():
+	RATING_DIMENSIONS = ( "fun", "rhythm", "flow", "pattern_quality", "readability", "level_quality" )
+
+	def __init__(self, db):
+		self._db = db
+		columns = db.get_ranking_columns()
+		self._song_ids = numpy.fromiter((row[0] for row in columns), dtype = numpy.int64, count = len(columns))
+		self._thumbs_up = numpy.fromiter((row[1] or 0 for row in columns), dtype = numpy.float64, count = len(columns))
+		self._thumbs_down = numpy.fromiter((row[2] or 0 for row in columns), dtype = numpy.float64, count = len(columns))
+		self._recommended = numpy.fromiter((bool(row[3]) for row in columns), dtype = bool, count = len(columns))
+		self._ratings = numpy.array([ row[4 : 10] for row in columns ], dtype = numpy.float64).reshape(len(columns), len(self.RATING_DIMENSIONS))
+		self._difficulties = numpy.fromiter((row[10] for row in columns), dtype = numpy.uint8, count = len(columns))
+
+		# Categories are a bitmask of 64-bit words per song; bit (id - 1)
+		# corresponds to category id
+		self._category_ids = db.get_categories()
+		word_count = max(1, (max(self._category_ids.values(), default = 0) + 63) // 64)
+		self._categories = numpy.zeros((len(columns), word_count), dtype = numpy.uint64)
+		if len(self._song_ids) > 0:
+			links = numpy.array(db.get_song_category_links(), dtype = numpy.int64).reshape(-1, 2)
+			rows = numpy.minimum(numpy.searchsorted(self._song_ids, links[:, 0]), len(self._song_ids) - 1)
+			known = self._song_ids[rows] == links[:, 0]
+			(rows, bits) = (rows[known], links[known, 1] - 1)
+			numpy.bitwise_or.at(self._categories, (rows, bits // 64), numpy.left_shift(numpy.uint64(1), (bits % 64).astype(numpy.uint64)))
+
+	def __len__(self):
+		return len(self._song_ids)
+
+	@property
+	def total_votes(self):
+		return self._thumbs_up + self._thumbs_down
+
+	def raw_percentage(self):
+		total_votes = self.total_votes
+		return numpy.divide(self._thumbs_up * 100, total_votes, out = numpy.zeros_like(total_votes), where = total_votes > 0)
+
+	def bayesian_percentage(self):
+		# Same as Song.percentage
+		total_votes = self.total_votes
+		return numpy.where(total_votes > 0, (self._thumbs_up + 1) / (total_votes + 2) * 100, 0)
+
+	def wilson_lower_bound(self, z = 1.96):
+		# Lower bound of the Wilson score confidence interval of the share of
+		# upvotes, in percent
+		n = self.total_votes
+		safe_n = numpy.maximum(n, 1)
+		p = self._thumbs_up / safe_n
+		bound = (p + z * z / (2 * safe_n) - z * numpy.sqrt((p * (1 - p) + z * z / (4 * safe_n)) / safe_n)) / (1 + z * z / safe_n)
+		return numpy.where(n > 0, bound * 100, 0)
+
+	def rating_blend(self, weights):
+		# Weighted mean of the rating dimensions, e.g., { "fun": 2, "flow": 1 };
+		# songs without ratings score 0
+		weight_vector = numpy.array([ weights.get(dimension, 0) for dimension in self.RATING_DIMENSIONS ], dtype = numpy.float64)
+		if weight_vector.sum() == 0:
+			raise ValueError("Rating weights %s give no weight to the dimensions %s." % (str(weights), ", ".join(self.RATING_DIMENSIONS)))
+		return numpy.nan_to_num(self._ratings) @ weight_vector / weight_vector.sum()
+
+	def _category_mask(self, names):
+		mask = numpy.zeros(self._categories.shape[1], dtype = numpy.uint64)
+		for name in names:
+			if name in self._category_ids:
+				bit = self._category_ids[name] - 1
+				mask[bit // 64] |= numpy.uint64(1) << numpy.uint64(bit % 64)
+		return mask
+
+	def select(self, must_have_difficulties = None, minimum_votes = None, must_be_recommended = False, include_categories = None, exclude_categories = None):
+		selection = numpy.ones(len(self), dtype = bool)
+		if must_have_difficulties is not None:
+			difficulty_mask = Song.difficulty_mask_of(must_have_difficulties)
+			selection &= (self._difficulties & difficulty_mask) == difficulty_mask
+		if minimum_votes is not None:
+			selection &= self.total_votes > minimum_votes
+		if must_be_recommended:
+			selection &= self._recommended
+		if include_categories is not None:
+			if any(name not in self._category_ids for name in include_categories):
+				selection[:] = False
+			mask = self._category_mask(include_categories)
+			selection &= ((self._categories & mask) == mask).all(axis = 1)
+		if exclude_categories is not None:
+			mask = self._category_mask(exclude_categories)
+			selection &= ~(self._categories & mask).any(axis = 1)
+		return selection
+
+	def top_k(self, scores, k, selection = None):
+		# Indices of the k highest scores (descending), optionally restricted
+		# to a boolean selection. Ties are broken by descending song id, just
+		# like search_songs() does.
+		candidates = numpy.arange(len(self)) if (selection is None) else numpy.flatnonzero(selection)
+		candidate_scores = scores[candidates]
+		if 0 < k < len(candidates):
+			# Keep everything tied with the k-th highest score so that the
+			# tie breaker decides which of those make it
+			threshold = numpy.partition(candidate_scores, len(candidates) - k)[len(candidates) - k]
+			keep = candidate_scores >= threshold
+			(candidates, candidate_scores) = (candidates[keep], candidate_scores[keep])
+		return candidates[numpy.lexsort((-self._song_ids[candidates], -candidate_scores))[:k]]
+
+	def songs(self, indices):
+		return self._db.get_songs_by_id(self._song_ids[indices])
+
+	def top_songs(self, scores, k, selection = None):
+		return self.songs(self.top_k(scores, k, selection))
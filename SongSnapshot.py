@@ -0,0 +1,198 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import sys
+import json
+import zlib
+import array
+import struct
+import itertools
+import collections
+
+# Snapshots store tables column by column in row groups. Every column of a
+# row group is compressed separately; it consists of a NULL bitmap followed by
+# either 64-bit integers, doubles or the lengths of UTF-8 strings followed by
+# the strings themselves. All numbers are little endian.
+#
+#   file        := magic version record* end_record
+#   record      := kind (1 byte) length (uint32) payload
+#   table       := "T" JSON { "name", "columns" }
+#   row group   := "G" row_count (uint32) (type (1 byte) length (uint32) zlib data)*
+#   end_record  := "E" JSON { "row_counts" }
+
+class SnapshotFormatException(Exception): pass
+
+def _pack_array(typecode, values):
+	data = array.array(typecode, values)
+	if sys.byteorder == "big":
+		data.byteswap()
+	return data.tobytes()
+
+def _unpack_array(typecode, data):
+	values = array.array(typecode)
+	values.frombytes(data)
+	if sys.byteorder == "big":
+		values.byteswap()
+	return values
+
+class SnapshotWriter():
+	_MAGIC = b"pybsaberdb snapshot\x00"
+	_VERSION = 1
+
+	def __init__(self, f, row_group_size = 16384, compression_level = 6):
+		self._f = f
+		self._row_group_size = row_group_size
+		self._compression_level = compression_level
+		self._row_counts = { }
+		self._f.write(self._MAGIC + struct.pack("<I", self._VERSION))
+
+	@property
+	def row_counts(self):
+		return self._row_counts
+
+	def _write_record(self, kind, payload):
+		self._f.write(kind + struct.pack("<I", len(payload)))
+		self._f.write(payload)
+
+	@staticmethod
+	def _encode_column(values):
+		nulls = bytearray((len(values) + 7) // 8)
+		for (index, value) in enumerate(values):
+			if value is None:
+				nulls[index >> 3] |= 1 << (index & 7)
+		present = [ value for value in values if value is not None ]
+		if all(isinstance(value, int) for value in present):
+			return (b"i", bytes(nulls) + _pack_array("q", (0 if (value is None) else value for value in values)))
+		elif all(isinstance(value, (int, float)) for value in present):
+			return (b"f", bytes(nulls) + _pack_array("d", (0 if (value is None) else value for value in values)))
+		elif all(isinstance(value, str) for value in present):
+			encoded = [ b"" if (value is None) else value.encode("utf-8") for value in values ]
+			return (b"s", bytes(nulls) + _pack_array("q", (len(value) for value in encoded)) + b"".join(encoded))
+		else:
+			raise TypeError("Column of mixed types cannot be stored in a snapshot: %s" % (str(set(type(value).__name__ for value in present))))
+
+	def _write_row_group(self, rows):
+		payload = [ struct.pack("<I", len(rows)) ]
+		for values in zip(*rows):
+			(type_code, data) = self._encode_column(values)
+			data = zlib.compress(data, self._compression_level)
+			payload.append(type_code + struct.pack("<I", len(data)) + data)
+		self._write_record(b"G", b"".join(payload))
+
+	def write_table(self, name, columns, rows):
+		self._write_record(b"T", json.dumps({ "name": name, "columns": columns }).encode("utf-8"))
+		self._row_counts[name] = 0
+		rows = iter(rows)
+		while True:
+			row_group = list(itertools.islice(rows, self._row_group_size))
+			if len(row_group) == 0:
+				break
+			self._write_row_group(row_group)
+			self._row_counts[name] += len(row_group)
+
+	def finish(self):
+		self._write_record(b"E", json.dumps({ "row_counts": self._row_counts }).encode("utf-8"))
+
+class SnapshotReader():
+	def __init__(self, f):
+		self._f = f
+		self._row_counts = None
+		magic = self._read(len(SnapshotWriter._MAGIC))
+		if magic != SnapshotWriter._MAGIC:
+			raise SnapshotFormatException("Not a song database snapshot.")
+		(version, ) = struct.unpack("<I", self._read(4))
+		if version != SnapshotWriter._VERSION:
+			raise SnapshotFormatException("Unsupported snapshot version %d." % (version))
+
+	@property
+	def row_counts(self):
+		return self._row_counts
+
+	def _read(self, length):
+		data = self._f.read(length)
+		if len(data) != length:
+			raise SnapshotFormatException("Snapshot is truncated.")
+		return data
+
+	def _read_record(self):
+		kind = self._read(1)
+		(length, ) = struct.unpack("<I", self._read(4))
+		return (kind, self._read(length))
+
+	@staticmethod
+	def _decode_column(type_code, data, row_count):
+		null_size = (row_count + 7) // 8
+		(nulls, data) = (data[ : null_size], data[null_size : ])
+		if type_code == b"i":
+			values = _unpack_array("q", data).tolist()
+		elif type_code == b"f":
+			values = _unpack_array("d", data).tolist()
+		elif type_code == b"s":
+			lengths = _unpack_array("q", data[ : 8 * row_count])
+			text = data[8 * row_count : ]
+			values = [ ]
+			offset = 0
+			for length in lengths:
+				values.append(text[offset : offset + length].decode("utf-8"))
+				offset += length
+		else:
+			raise SnapshotFormatException("Unknown column type %s." % (str(type_code)))
+		if len(values) != row_count:
+			raise SnapshotFormatException("Column has %d values, expected %d." % (len(values), row_count))
+		if any(nulls):
+			for index in range(row_count):
+				if (nulls[index >> 3] >> (index & 7)) & 1:
+					values[index] = None
+		return values
+
+	def _decode_row_group(self, payload, column_count):
+		(row_count, ) = struct.unpack("<I", payload[ : 4])
+		offset = 4
+		columns = [ ]
+		for i in range(column_count):
+			type_code = payload[offset : offset + 1]
+			(length, ) = struct.unpack("<I", payload[offset + 1 : offset + 5])
+			columns.append(self._decode_column(type_code, zlib.decompress(payload[offset + 5 : offset + 5 + length]), row_count))
+			offset += 5 + length
+		return list(zip(*columns))
+
+	def read(self):
+		# Yields (table name, column names, rows) for every row group
+		table = None
+		row_counts = collections.Counter()
+		while True:
+			(kind, payload) = self._read_record()
+			if kind == b"T":
+				table = json.loads(payload)
+			elif kind == b"G":
+				if table is None:
+					raise SnapshotFormatException("Row group without a table.")
+				rows = self._decode_row_group(payload, len(table["columns"]))
+				row_counts[table["name"]] += len(rows)
+				yield (table["name"], table["columns"], rows)
+			elif kind == b"E":
+				self._row_counts = json.loads(payload)["row_counts"]
+				if any(row_counts[name] != row_count for (name, row_count) in self._row_counts.items()):
+					raise SnapshotFormatException("Snapshot row counts do not match.")
+				break
+			else:
+				raise SnapshotFormatException("Unknown record type %s." % (str(kind)))
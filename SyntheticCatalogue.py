@@ -0,0 +1,125 @@
+#	pybsaberdb - Python interface to BeastSaber database
+#	Copyright (C) 2019-2020 Johannes Bauer
+#
+#	This file is part of pybsaberdb.
+#
+#	pybsaberdb is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	pybsaberdb is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with pybsaberdb; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import json
+import random
+import hashlib
+
+class SyntheticCatalogue():
+	# A deterministic, made-up song catalogue which serves as a stand-in for
+	# BeastSaber in benchmarks. Every song is derived from its index alone, so
+	# songs can be generated in any order without keeping the catalogue in
+	# memory.
+	_CATEGORIES = ( "electronic", "pop", "rock", "metal", "anime", "hip hop", "dubstep", "drum and bass", "video game", "meme", "j-pop", "k-pop", "rap", "country", "classical", "jazz", "punk", "trance", "house", "ost" )
+	_WORDS = ( "love", "night", "fire", "dream", "heart", "light", "dance", "star", "world", "time", "sky", "rain", "angel", "ghost", "storm", "road", "gold", "neon", "shadow", "city", "ocean", "summer", "zero", "wild", "electric", "broken", "final", "crystal", "rise", "lost" )
+	_DIFFICULTIES = ( ("easy", "Easy", 0.45), ("normal", "Normal", 0.6), ("hard", "Hard", 0.8), ("expert", "Expert", 0.85), ("expert+", "Expert+", 0.6) )
+	_RATINGS = ( "fun_factor", "rhythm", "flow", "pattern_quality", "readability", "level_quality" )
+	_SONG_COLUMNS = ( "id", "song_key", "level_author", "title", "hash", "rating_update_timet", "rating_fun", "rating_rhythm", "rating_flow", "rating_pattern_quality", "rating_readability", "rating_level_quality", "metadata_update_timet", "difficulty_easy", "difficulty_normal", "difficulty_hard", "difficulty_expert", "difficulty_expertplus", "recommended", "thumbs_up", "thumbs_down", "categories_json", "vote_velocity" )
+
+	def __init__(self, song_count, seed = 0, timestamp = 1577836800):
+		self._song_count = song_count
+		self._seed = seed
+		self._timestamp = timestamp
+		self._author_count = max(1, song_count // 20)
+
+	@property
+	def song_count(self):
+		return self._song_count
+
+	@staticmethod
+	def song_key(index):
+		return "%x" % (index + 1)
+
+	@staticmethod
+	def song_index(song_key):
+		return int(song_key, 16) - 1
+
+	def song(self, index):
+		assert(0 <= index < self._song_count)
+		rng = random.Random(self._seed * 1000003 + index)
+		song_key = self.song_key(index)
+		total_votes = int(rng.lognormvariate(3, 1.5))
+		thumbs_up = round(total_votes * rng.betavariate(8, 1.5))
+		difficulties = [ name for (name, display_name, probability) in self._DIFFICULTIES if rng.random() < probability ]
+		if len(difficulties) == 0:
+			difficulties = [ "expert" ]
+		return {
+			"song_key":			song_key,
+			"hash":				hashlib.sha1(("%d:%s" % (self._seed, song_key)).encode("ascii")).hexdigest(),
+			"title":			" ".join(rng.choice(self._WORDS) for i in range(rng.randint(1, 4))).title(),
+			# Few authors create most of the levels
+			"level_author":		"mapper%d" % (int(rng.paretovariate(1.2)) % self._author_count),
+			"difficulties":		difficulties,
+			"categories":		sorted(set(rng.choice(self._CATEGORIES) for i in range(rng.choice((0, 1, 1, 2, 2, 3))))),
+			"thumbs_up":		thumbs_up,
+			"thumbs_down":		total_votes - thumbs_up,
+			"recommended":		rng.random() < 0.02,
+			"ratings":			{ name: round(rng.uniform(1, 5), 2) for name in self._RATINGS },
+		}
+
+	def song_list_page(self, page, page_size = 20):
+		# Newest (i.e., highest index) songs first
+		first = self._song_count - 1 - (page - 1) * page_size
+		indices = range(first, max(first - page_size, -1), -1)
+		songs = [ self.song(index) for index in indices ]
+		return {
+			"songs":		[ { "song_key": song["song_key"], "level_author_name": song["level_author"], "title": song["title"], "hash": song["hash"] } for song in songs ],
+			"next_page":	(page + 1) if (first - page_size >= 0) else None,
+		}
+
+	def rating(self, index):
+		return { "average_ratings": self.song(index)["ratings"] }
+
+	def details_html(self, index, page_size = 64 * 1024):
+		# Mimics the layout of a song page; navigation precedes the post and
+		# comments follow it, filling the page up to roughly page_size bytes.
+		song = self.song(index)
+		post = [ "<article class=\"post\"><header class=\"post-header\"><h1>%s</h1>" % (song["title"]) ]
+		if song["recommended"]:
+			post.append("<div class=\"post-recommended bsaber-tooltip -recommended\"></div>")
+		display_names = { name: display_name for (name, display_name, probability) in self._DIFFICULTIES }
+		post += [ "<a class=\"post-difficulty\">%s</a>" % (display_names[difficulty]) for difficulty in song["difficulties"] ]
+		post.append("<span class=\"bsaber-categories\">%s</span>" % ("".join("<a>%s</a>" % (category.title()) for category in song["categories"])))
+		post.append("<span class=\"post-stat\"><i class=\"fa fa-thumbs-up fa-fw\"></i> %d</span>" % (song["thumbs_up"]))
+		post.append("<span class=\"post-stat\"><i class=\"fa fa-thumbs-down fa-fw\"></i> %d</span>" % (song["thumbs_down"]))
+		post.append("</header><div class=\"entry-content\"><p>Mapped by %s.</p></div></article>" % (song["level_author"]))
+		post = "".join(post)
+		navigation = "<nav><ul>%s</ul></nav>" % ("".join("<li><a href=\"/songs/%s/\">%s</a></li>" % (self.song_key(i), word) for (i, word) in enumerate(self._WORDS)))
+		comment = "<li class=\"comment\"><div class=\"comment-author\">someone</div><p>%s</p></li>" % (" ".join(self._WORDS))
+		comment_count = max(0, (page_size - len(post) - len(navigation)) // len(comment))
+		return ("<!DOCTYPE html><html><head><title>%s</title></head><body>%s%s<ol class=\"comments\">%s</ol><footer>BeastSaber</footer></body></html>" % (song["title"], navigation, post, comment * comment_count)).encode("utf-8")
+
+	def _song_row(self, index):
+		song = self.song(index)
+		difficulties = set(song["difficulties"])
+		ratings = song["ratings"]
+		return (index + 1, song["song_key"], song["level_author"], song["title"], song["hash"], self._timestamp, ratings["fun_factor"], ratings["rhythm"], ratings["flow"], ratings["pattern_quality"], ratings["readability"], ratings["level_quality"], self._timestamp, "easy" in difficulties, "normal" in difficulties, "hard" in difficulties, "expert" in difficulties, "expert+" in difficulties, song["recommended"], song["thumbs_up"], song["thumbs_down"], json.dumps(song["categories"]), None)
+
+	def db_row_groups(self, batch_size = 10000):
+		# Fully populated songs, categories and song_categories tables in the
+		# form that SongDatabase.bulk_load() expects
+		category_ids = { name: category_id for (category_id, name) in enumerate(self._CATEGORIES, 1) }
+		yield ("categories", [ "id", "name" ], [ (category_id, name) for (name, category_id) in category_ids.items() ])
+		for first in range(0, self._song_count, batch_size):
+			rows = [ self._song_row(index) for index in range(first, min(first + batch_size, self._song_count)) ]
+			yield ("songs", self._SONG_COLUMNS, rows)
+			yield ("song_categories", [ "song_id", "category_id" ], [ (row[0], category_ids[category]) for row in rows for category in json.loads(row[21]) ])